@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+from builder.core.action import Action
+from builder.core.fetch import CACHE_DIR, Manifest, cache_entries, cache_max_size, gc_cache, hash_file, parse_size, \
+    remove_cache_entry
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+
+def _hash_entry(entry):
+    try:
+        return hash_file(entry.path)
+    except OSError:
+        # evicted while verifying
+        return entry.digest
+
+
+def _packages_by_digest():
+    """ Maps cache digests back to the names of the packages they were downloaded as """
+    packages = {}
+    for package, digest in Manifest._load_local().items():
+        packages.setdefault(digest, []).append(package)
+    return packages
+
+
+class Cache(Action):
+    """
+    Manages the package cache in ~/.builder/pkg-cache:
+        builder cache stats - list the cached packages, least recently used first
+        builder cache gc [--max-size SIZE] - evict the least recently used packages until the cache fits
+        builder cache verify [--jobs N] - re-hash every cached package, removing any that are corrupt
+    """
+
+    def is_main(self):
+        return True
+
+    def run(self, env):
+        parser = argparse.ArgumentParser(prog='builder cache')
+        parser.add_argument('operation', choices=['stats', 'gc', 'verify'])
+        parser.add_argument('--max-size', type=parse_size, default=None,
+                            help='Size to shrink the cache to, e.g. 5G (default: BUILDER_PKG_CACHE_MAX_SIZE or 10G)')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of packages to verify concurrently')
+        args = parser.parse_known_args(env.args.args)[0]
+
+        getattr(self, '_' + args.operation)(args)
+
+    def _stats(self, args):
+        entries = cache_entries()
+        packages = _packages_by_digest()
+        now = time.time()
+        for entry in entries:
+            print('  {} {:>10} used {:.1f} days ago {}'.format(
+                entry.digest[:12], _format_size(entry.size + entry.tree_size), (now - entry.atime) / 86400,
+                ', '.join(packages.get(entry.digest, ['(unknown)']))))
+        print('Package cache {}: {} packages, {} of {}'.format(
+            CACHE_DIR, len(entries), _format_size(sum(entry.size + entry.tree_size for entry in entries)),
+            _format_size(cache_max_size())))
+
+    def _gc(self, args):
+        evicted = gc_cache(args.max_size)
+        for entry in evicted:
+            print('Evicted {} ({})'.format(entry.digest, _format_size(entry.size + entry.tree_size)))
+        print('Evicted {} packages, freeing {}'.format(
+            len(evicted), _format_size(sum(entry.size + entry.tree_size for entry in evicted))))
+
+    def _verify(self, args):
+        entries = cache_entries()
+        packages = _packages_by_digest()
+
+        # entries are named for their sha256, so each one can be checked on its own
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            digests = executor.map(_hash_entry, entries)
+            corrupt = [entry for entry, digest in zip(entries, digests) if digest != entry.digest]
+
+        for entry in corrupt:
+            print('Removing corrupt package {} ({})'.format(
+                entry.path, ', '.join(packages.get(entry.digest, ['(unknown)']))))
+            remove_cache_entry(entry.path)
+        print('Verified {} packages, {} corrupt'.format(len(entries), len(corrupt)))
@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
+from hashlib import sha256
+import json
 import os
 import re
 import shutil
@@ -8,14 +10,19 @@ from functools import lru_cache, partial
 from pathlib import Path
 
 from builder.core.action import Action
+from builder.core.scheduler import run_graph
 from builder.core.toolchain import Toolchain
-from builder.core.util import UniqueList, run_command, unique_flags
+from builder.core.util import UniqueList, run_command, unique_flags, where
+
+INSTALL_CACHE_DIR = os.path.expanduser(os.path.join('~', '.builder', 'install-cache'))
+# Records the configure inputs of each project build dir, for incremental builds
+STAMP_FILE = '.builder-stamp'
 
 
 @lru_cache(1)
 def _find_cmake():
     for cmake_alias in ['cmake3', 'cmake']:
-        cmake = shutil.which(cmake_alias)
+        cmake = where(cmake_alias, resolve_symlinks=False)
         if cmake:
             return cmake
     raise Exception("cmake not found")
@@ -24,7 +31,7 @@ def _find_cmake():
 @lru_cache(1)
 def _find_ctest():
     for ctest_alias in ['ctest3', 'ctest']:
-        ctest = shutil.which(ctest_alias)
+        ctest = where(ctest_alias, resolve_symlinks=False)
         if ctest:
             return ctest
     raise Exception("cmake not found")
@@ -39,7 +46,7 @@ def cmake_path(cross_compile=False):
 def cmake_version(cross_compile=False):
     if cross_compile:
         return '3.17.1'
-    output = run_command([cmake_path(), '--version'], quiet=True).output
+    output = run_command([cmake_path(), '--version'], quiet=True, capture='full').output
     m = re.match(r'cmake(3?) version ([\d\.])', output)
     if m:
         return m.group(2)
@@ -100,7 +107,189 @@ def _project_dirs(env, project):
     return source_dir, build_dir, install_dir
 
 
+def _parallel_level(sh):
+    """ The total number of compile jobs available to cmake builds """
+    level = sh.getenv('CMAKE_BUILD_PARALLEL_LEVEL')
+    if level and level.isdigit():
+        return int(level)
+    return os.cpu_count() or 1
+
+
+def _dependency_graph(env, project):
+    """ Returns the upstream projects of project in build order, and a map of name -> immediate dependency names """
+    projects = []
+    graph = {}
+
+    def _visit(proj):
+        deps = [d for d in proj.get_dependencies(env.spec) if d.name != project.name]
+        for dep in deps:
+            if dep.name not in graph:
+                graph[dep.name] = []
+                graph[dep.name] = _visit(dep)
+                projects.append(dep)
+        return [d.name for d in deps]
+
+    _visit(project)
+    return projects, graph
+
+
+def _build_dependencies(env, project, cmake_extra):
+    """
+    Builds all upstream projects of project. Independent projects are built concurrently, up to
+    --build-jobs at a time, with the CMAKE_BUILD_PARALLEL_LEVEL budget split between them.
+    """
+    # resolve the whole graph up front, on this thread, so that workers only have to build
+    projects, graph = _dependency_graph(env, project)
+    if not projects:
+        return
+    by_name = {p.name: p for p in projects}
+
+    jobs = min(env.args.build_jobs or 1, len(projects))
+    if env.toolchain.cross_compile and jobs > 1:
+        print('Building dependencies serially, concurrent builds are not supported when cross compiling')
+        jobs = 1
+    parallel_level = max(1, _parallel_level(env.shell) // jobs)
+    if jobs > 1:
+        print('Building {} dependencies with {} workers, {} compile jobs each'.format(
+            len(projects), jobs, parallel_level))
+
+    def _build(name):
+        # prefix output with the project name when it will be interleaved with other builds
+        _configure_and_build(env, by_name[name], cmake_extra, parallel_level=parallel_level,
+                             dependencies=[by_name[dep] for dep in graph[name]],
+                             prefix=name if jobs > 1 else None)
+
+    run_graph([p.name for p in projects], lambda name: graph[name], _build, jobs)
+
+
 def _build_project(env, project, cmake_extra, build_tests=False, args_transformer=None, coverage=False):
+    # build dependencies first, let cmake decide what needs doing
+    _build_dependencies(env, project, cmake_extra)
+    _configure_and_build(env, project, cmake_extra, build_tests, args_transformer, coverage)
+
+
+# install cache keys of the projects built or restored so far, by absolute build dir. None if not cacheable
+_install_cache_keys = {}
+
+
+def _git_head(path):
+    """ Returns the commit checked out at path, or None if path is not a git checkout """
+    result = run_command('git', 'rev-parse', 'HEAD', working_dir=path, quiet=True, capture='full')
+    if result.returncode != 0:
+        return None
+    return result.output.strip()
+
+
+def _source_revision(path):
+    """ Returns the commit checked out at path, or None if path is not a clean git checkout """
+    revision = _git_head(path)
+    if revision is None:
+        return None
+    result = run_command('git', 'status', '--porcelain', '--untracked-files=no', working_dir=path, quiet=True,
+                         capture='full')
+    if result.returncode != 0 or result.output.strip():
+        return None
+    return revision
+
+
+# the config keys which can change what a dependency installs. Everything else (e.g. variants, test steps) can't,
+# and may hold values that don't serialize reproducibly
+INSTALL_CACHE_CONFIG_KEYS = ('c', 'cxx', 'cmake_args', 'env', 'build_env')
+
+
+def _install_cache_key(env, project, cmake_args, dep_keys):
+    """
+    Hash of everything that goes into a dependency's installed files, or None if it can't be cached.
+    Raises TypeError if any of the inputs aren't plain JSON values
+    """
+    if None in dep_keys:
+        return None
+    revision = _source_revision(project.path)
+    if revision is None:
+        return None
+    config = project.get_config(env.spec)
+    material = json.dumps({
+        'revision': revision,
+        'config': {key: config.get(key) for key in INSTALL_CACHE_CONFIG_KEYS},
+        'toolchain': env.toolchain.name,
+        'cmake_args': cmake_args,
+        'dependencies': sorted(dep_keys),
+    }, sort_keys=True)
+    return sha256(material.encode('utf-8')).hexdigest()
+
+
+def _configure_stamp(env, project, cmake_args):
+    """ Hash of the inputs which require cmake to re-configure a project in an incremental build """
+    material = json.dumps({
+        'cmake_args': cmake_args,
+        'toolchain': env.toolchain.name,
+        'revision': _git_head(project.path),
+    }, sort_keys=True)
+    return sha256(material.encode('utf-8')).hexdigest()
+
+
+def _read_stamp(build_dir):
+    try:
+        with open(os.path.join(build_dir, STAMP_FILE)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _write_stamp(build_dir, stamp):
+    """ Records stamp for build_dir, or removes it if stamp is None """
+    stamp_path = os.path.join(build_dir, STAMP_FILE)
+    if stamp is None:
+        if os.path.isfile(stamp_path):
+            os.remove(stamp_path)
+        return
+    with open(stamp_path, 'w') as f:
+        f.write(stamp)
+
+
+def _restore_install_cache(key, install_dir):
+    """ Copies cached installed files into install_dir, returns False on a cache miss """
+    cache_path = os.path.join(INSTALL_CACHE_DIR, key)
+    if not os.path.isdir(cache_path):
+        return False
+    print('Restoring cached install tree {} to {}'.format(cache_path, install_dir))
+    shutil.copytree(cache_path, install_dir, symlinks=True, dirs_exist_ok=True)
+    return True
+
+
+def _save_install_cache(key, build_dir, install_dir):
+    """ Copies the files cmake installed (per install_manifest.txt) into the cache, under key """
+    manifest_path = os.path.join(build_dir, 'install_manifest.txt')
+    cache_path = os.path.join(INSTALL_CACHE_DIR, key)
+    if os.path.isdir(cache_path) or not os.path.isfile(manifest_path):
+        return
+
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(manifest_path) as manifest:
+            for installed in manifest.read().splitlines():
+                rel_path = os.path.relpath(installed, install_dir)
+                if rel_path.startswith(os.pardir):
+                    print('WARNING: {} was installed outside of {}, not caching'.format(installed, install_dir))
+                    return
+                dest = os.path.join(tmp_path, rel_path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if os.path.islink(installed):
+                    os.symlink(os.readlink(installed), dest)
+                else:
+                    shutil.copy2(installed, dest)
+        os.makedirs(INSTALL_CACHE_DIR, exist_ok=True)
+        os.rename(tmp_path, cache_path)
+        print('Cached install tree to {}'.format(cache_path))
+    except Exception as ex:
+        print('WARNING: failed to cache install tree to {}: {}'.format(cache_path, ex))
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _configure_and_build(env, project, cmake_extra, build_tests=False, args_transformer=None, coverage=False,
+                         parallel_level=None, dependencies=None, prefix=None):
     sh = env.shell
     config = project.get_config(env.spec)
     build_env = []
@@ -109,10 +298,6 @@ def _build_project(env, project, cmake_extra, build_tests=False, args_transforme
         # We need to set the envrionment variable of GO_PATH for cross compile
         build_env = ["GO_PATH={}\n".format(env.variables['go_path'])]
 
-    # build dependencies first, let cmake decide what needs doing
-    for dep in project.get_dependencies(env.spec):
-        _build_project(env, dep, cmake_extra)
-
     project_source_dir, project_build_dir, project_install_dir = _project_dirs(
         env, project)
     abs_project_build_dir = project_build_dir
@@ -120,8 +305,13 @@ def _build_project(env, project, cmake_extra, build_tests=False, args_transforme
         abs_project_build_dir = os.path.join(env.root_dir, project_build_dir)
     sh.mkdir(abs_project_build_dir)
 
-    # If cmake has already run, assume we're good
-    if os.path.isfile(os.path.join(abs_project_build_dir, 'CMakeCache.txt')):
+    # If the project was already built or restored from cache during this run, we're good
+    if abs_project_build_dir in _install_cache_keys:
+        return
+    # If cmake has already run, assume we're good. Incremental builds keep the build dir around,
+    # so they instead compare configure stamps below
+    incremental = getattr(env.args, 'incremental', False)
+    if not incremental and os.path.isfile(os.path.join(abs_project_build_dir, 'CMakeCache.txt')):
         return
 
     cmake = toolchain.cmake_binary()
@@ -192,7 +382,11 @@ def _build_project(env, project, cmake_extra, build_tests=False, args_transforme
         with open(toolchain.env_file, 'a') as f:
             f.writelines(build_env)
     # set parallism via env var (cmake's --parallel CLI option doesn't exist until 3.12)
-    if os.environ.get('CMAKE_BUILD_PARALLEL_LEVEL') is None:
+    exec_env = None
+    if parallel_level is not None:
+        # concurrently built dependencies each get their share of the budget
+        exec_env = {'CMAKE_BUILD_PARALLEL_LEVEL': parallel_level}
+    elif sh.getenv('CMAKE_BUILD_PARALLEL_LEVEL') is None:
         sh.setenv('CMAKE_BUILD_PARALLEL_LEVEL', str(os.cpu_count()))
 
     working_dir = env.root_dir if toolchain.cross_compile else os.getcwd()
@@ -203,12 +397,35 @@ def _build_project(env, project, cmake_extra, build_tests=False, args_transforme
     # Thus, adding a new method 'unique_flags' to remove multiple declarations of those flags keeping the last occurrence.
     cmake_args = unique_flags(cmake_args, '-A', '-T')
 
-    # configure
-    sh.exec(*toolchain.shell_env, cmake, cmake_args, working_dir=working_dir, check=True)
+    # Upstream dependencies can be restored from the install cache instead of being built
+    cache_key = None
+    if dependencies is not None and env.args.build_cache and not toolchain.cross_compile and not sh.dryrun:
+        dep_keys = [_install_cache_keys.get(_project_dirs(env, dep)[1]) for dep in dependencies]
+        cache_key = _install_cache_key(env, project, cmake_args, dep_keys)
+        if cache_key and _restore_install_cache(cache_key, env.install_dir):
+            _install_cache_keys[abs_project_build_dir] = cache_key
+            return
+
+    # configure, unless an incremental build finds nothing has changed since the last configure
+    stamp = _configure_stamp(env, project, cmake_args) if incremental else None
+    if stamp and stamp == _read_stamp(abs_project_build_dir) and \
+            os.path.isfile(os.path.join(abs_project_build_dir, 'CMakeCache.txt')):
+        print('Configure inputs for {} are unchanged, skipping configure'.format(project.name))
+    else:
+        _write_stamp(abs_project_build_dir, None)
+        sh.exec(*toolchain.shell_env, cmake, cmake_args, working_dir=working_dir, env=exec_env, check=True,
+                prefix=prefix)
+        if stamp and not sh.dryrun:
+            _write_stamp(abs_project_build_dir, stamp)
 
     # build & install
     sh.exec(*toolchain.shell_env, cmake, "--build", project_build_dir, "--config",
-            build_config, "--target", "install", working_dir=working_dir, check=True)
+            build_config, "--target", "install", working_dir=working_dir, env=exec_env, check=True,
+            prefix=prefix)
+
+    if cache_key:
+        _save_install_cache(cache_key, abs_project_build_dir, env.install_dir)
+    _install_cache_keys[abs_project_build_dir] = cache_key
 
 
 class CMakeBuild(Action):
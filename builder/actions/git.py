@@ -1,10 +1,61 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
+from hashlib import sha256
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
 from builder.core.action import Action
+from builder.core.fetch import LockFile
 from builder.core.project import Project
 
+GIT_CACHE_DIR = os.path.expanduser(os.path.join('~', '.builder', 'git-cache'))
+GIT_CACHE_TIMEOUT = 600
+# branches and tags only: a mirror would also fetch refs/pull/*, every pull request ever opened against the repo
+GIT_CACHE_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+
+def _git_cache_path(url):
+    """ Each remote gets its own bare clone, named for readability and keyed by the full url """
+    name = os.path.basename(urlparse(url).path.rstrip('/'))
+    if name.endswith('.git'):
+        name = name[:-4]
+    key = sha256(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(GIT_CACHE_DIR, '{}-{}.git'.format(name, key))
+
+
+def update_git_cache(sh, url):
+    """
+    Creates or incrementally fetches a bare clone of url's branches and tags in the local git object store.
+    Returns the path to the clone, or None if it could not be updated.
+    """
+    path = _git_cache_path(url)
+    os.makedirs(GIT_CACHE_DIR, exist_ok=True)
+    with LockFile(path + '.lock', timeout=GIT_CACHE_TIMEOUT):
+        if os.path.isdir(path):
+            result = sh.exec('git', 'fetch', '--prune', '--quiet', 'origin',
+                             working_dir=path, always=True, retries=3)
+        else:
+            # clone to the side so that an interrupted clone never looks like a valid cache
+            tmp_path = path + '.tmp'
+            if os.path.exists(tmp_path):
+                sh.rm(tmp_path)
+            result = sh.exec('git', 'clone', '--bare', '--quiet', url, tmp_path, always=True, retries=3)
+            # a bare clone has no fetch refspec, so later fetches would only update FETCH_HEAD
+            for refspec in GIT_CACHE_REFSPECS:
+                if result.returncode != 0:
+                    break
+                result = sh.exec('git', 'config', '--add', 'remote.origin.fetch', refspec,
+                                 working_dir=tmp_path, always=True)
+            if result.returncode == 0:
+                os.rename(tmp_path, path)
+
+    if result.returncode != 0:
+        print('WARNING: Unable to update git cache for {}, cloning without it'.format(url))
+        return None
+    return path
+
 
 class DownloadSource(Action):
     """ Downloads the source for a given project """
@@ -12,6 +63,8 @@ class DownloadSource(Action):
     def __init__(self, **kwargs):
         self.project = kwargs['project']
         self.branch = kwargs.get('branch', 'main')
+        # None defers to --git-cache
+        self.git_cache = kwargs.get('git_cache', None)
         self.path = os.path.abspath(os.path.join(
             kwargs.get('path', '.'), self.project.name))
 
@@ -20,28 +73,92 @@ class DownloadSource(Action):
             print('Project {} already exists on disk'.format(self.project.name))
             return
 
+        self.clone(env)
+
+        # reload project now that it's on disk
+        sh = env.shell
+        sh.pushd(self.path)
+        self.project = Project.find_project(self.project.name)
+        sh.popd()
+
+    def clone(self, env, prefix=None):
+        """
+        Clones the project and checks out the branch. Does not change directory, so is safe to call from any thread.
+        If prefix is given, command output is prefixed with it, to tell concurrent clones apart
+        """
         sh = env.shell
 
+        # Borrow objects from the local git cache, so that only the delta comes over the network.
+        # Clones copy what they borrow, so they don't break when the cache prunes objects (e.g. kept clones
+        # in incremental builds)
+        reference = []
+        git_cache = self.git_cache if self.git_cache is not None else getattr(env.args, 'git_cache', False)
+        if git_cache:
+            cache_path = update_git_cache(sh, self.project.url)
+            if cache_path:
+                reference = ['--reference-if-able', cache_path, '--dissociate']
+
         print('Cloning {} from git'.format(self.project))
         if os.path.exists(self.path):
             sh.rm(self.path)
-        sh.exec("git", "clone", self.project.url,
-                self.path, always=True, retries=3)
-        sh.pushd(self.path)
+        sh.exec("git", "clone", *reference, self.project.url,
+                self.path, always=True, retries=3, prefix=prefix)
         try:
-            sh.exec("git", "checkout", self.branch,
+            sh.exec("git", "checkout", self.branch, working_dir=self.path,
                     always=True, quiet=True, check=True)
             print('Switched to branch {}'.format(self.branch))
         except:
             print("Project {} does not have a branch named {}, using main".format(
                 self.project.name, self.branch))
 
+        if git_cache and os.path.isfile(os.path.join(self.path, '.gitmodules')):
+            self._clone_submodules(sh, prefix)
         sh.exec('git', 'submodule', 'update',
-                '--init', '--recursive', retries=3)
+                '--init', '--recursive', working_dir=self.path, retries=3, prefix=prefix)
 
-        # reload project now that it's on disk
-        self.project = Project.find_project(self.project.name)
-        sh.popd()
+    def update(self, env, prefix=None):
+        """
+        Brings a clone kept from a previous (incremental) build up to date: fetches, then checks out the branch
+        or pinned revision, as clone would. Does not change directory, so is safe to call from any thread
+        """
+        sh = env.shell
+        print('Updating {} from git'.format(self.project))
+        sh.exec('git', 'fetch', '--quiet', '--tags', 'origin', working_dir=self.path, always=True, retries=3,
+                check=True, prefix=prefix)
+        # branches are checked out as they are on the remote, revisions and tags as they are
+        for candidate in ('origin/{}'.format(self.branch), self.branch, 'origin/HEAD'):
+            result = sh.exec('git', 'rev-parse', '--verify', '--quiet', candidate + '^{commit}',
+                             working_dir=self.path, always=True, quiet=True, capture='full')
+            if result.returncode == 0:
+                break
+        if candidate == 'origin/HEAD':
+            print("Project {} does not have a branch named {}, using main".format(
+                self.project.name, self.branch))
+        sh.exec('git', 'checkout', '--quiet', '--detach', result.output.strip(), working_dir=self.path,
+                always=True, check=True)
+        print('Switched {} to {}'.format(self.project.name, candidate))
+
+        sh.exec('git', 'submodule', 'update',
+                '--init', '--recursive', working_dir=self.path, retries=3, prefix=prefix)
+
+    def _clone_submodules(self, sh, prefix):
+        """ Clones the top level submodules through the git cache, nested ones are left to submodule update """
+        sh.exec('git', 'submodule', 'init', working_dir=self.path, quiet=True)
+        # init resolves relative urls, so read them back from the clone's config rather than .gitmodules
+        result = sh.exec('git', 'config', '--get-regexp', r'^submodule\..*\.url$',
+                         working_dir=self.path, quiet=True, capture='full')
+        if not result or result.returncode != 0:
+            return
+        for line in result.output.splitlines():
+            key, url = line.split(' ', 1)
+            name = key[len('submodule.'):-len('.url')]
+            path = sh.exec('git', 'config', '--file', '.gitmodules', 'submodule.{}.path'.format(name),
+                           working_dir=self.path, quiet=True, capture='full')
+            cache_path = update_git_cache(sh, url)
+            if not path or path.returncode != 0 or not cache_path:
+                continue
+            sh.exec('git', 'submodule', 'update', '--reference', cache_path, '--dissociate',
+                    '--', path.output.strip(), working_dir=self.path, retries=3, prefix=prefix)
 
 
 class DownloadDependencies(Action):
@@ -50,7 +167,6 @@ class DownloadDependencies(Action):
     def run(self, env):
         project = env.project
         sh = env.shell
-        branch = env.branch
         spec = env.spec
         deps = project.get_dependencies(spec)
 
@@ -58,23 +174,60 @@ class DownloadDependencies(Action):
             deps += project.get_consumers(spec)
 
         if deps:
-            sh.rm(env.deps_dir)
+            # incremental builds keep previously downloaded dependencies, they are found on disk
+            if not getattr(env.args, 'incremental', False):
+                sh.rm(env.deps_dir)
             sh.mkdir(env.deps_dir)
             sh.pushd(env.deps_dir)
+            _download_all(env, deps, env.args.fetch_jobs)
+            sh.popd()
 
-            while deps:
-                dep = deps.pop(0)  # pop front
-                dep_proj = Project.find_project(dep.name)
-                if dep_proj.path:
-                    continue
 
-                dep_branch = branch if dep.revision is None else dep.revision
-                DownloadSource(project=dep_proj, branch=dep_branch, path=env.deps_dir).run(env)
+def _download_all(env, deps, jobs):
+    """
+    Clones deps and everything they transitively depend on (and their consumers, for downstream builds)
+    using up to jobs concurrent clones. Transitive dependencies are discovered as each clone lands.
+    """
+    spec = env.spec
+    seen = set()
+    running = {}
 
-                # grab updated project, collect transitive dependencies/consumers
-                dep_proj = Project.find_project(dep.name)
-                deps = dep_proj.get_dependencies(spec) + deps  # push front
-                if spec and spec.downstream:
-                    deps += dep_proj.get_consumers(spec)  # push back
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        def _submit(deps):
+            for dep in deps:
+                if dep.name in seen:
+                    continue
+                seen.add(dep.name)
 
-            sh.popd()
+                dep_proj = Project.find_project(dep.name)
+                dep_branch = env.branch if dep.revision is None else dep.revision
+                source = DownloadSource(project=dep_proj, branch=dep_branch, path=env.deps_dir)
+                prefix = dep_proj.name if jobs > 1 else None
+                if not dep_proj.path:
+                    running[executor.submit(source.clone, env, prefix)] = source
+                elif os.path.abspath(dep_proj.path) == source.path and \
+                        os.path.isdir(os.path.join(source.path, '.git')):
+                    # kept from a previous incremental build, and may no longer be at the revision wanted
+                    running[executor.submit(source.update, env, prefix)] = source
+
+        _submit(deps)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                source = running.pop(future)
+                future.result()
+
+                # Project discovery loads scripts, so is done here rather than on the worker
+                if source.project.path:
+                    # updated, so its config may have changed since it was loaded
+                    Project._projects.pop(source.project.name.lower(), None)
+                sh = env.shell
+                sh.pushd(source.path, quiet=True)
+                dep_proj = Project.find_project(source.project.name)
+                sh.popd(quiet=True)
+
+                # collect transitive dependencies/consumers
+                transitive = dep_proj.get_dependencies(spec)
+                if spec.downstream:
+                    transitive += dep_proj.get_consumers(spec)
+                _submit(transitive)
@@ -12,14 +12,20 @@ from functools import partial
 from builder.core.action import Action
 from builder.core.host import current_os, package_tool
 from builder.actions.script import Script
-from builder.core.toolchain import Toolchain
-from builder.core.util import UniqueList
+from builder.core.toolchain import Toolchain, invalidate_tool_cache
+from builder.core.util import UniqueList, invalidate_where_cache
 
 
 def set_dryrun(dryrun, env):
     env.shell.dryrun = dryrun
 
 
+def _packages_installed(env):
+    # newly installed executables must be visible to where(), and to compiler discovery
+    invalidate_where_cache()
+    invalidate_tool_cache()
+
+
 class InstallPackages(Action):
     """ Installs prerequisites to building. If packages are specified, only those packages will be installed. Otherwise, config packages will be installed. """
 
@@ -74,6 +80,7 @@ class InstallPackages(Action):
             pkg_install += packages
 
             sh.exec(*sudo, pkg_install, check=True, retries=3)
+            _packages_installed(env)
 
             if args.skip_install:
                 sh.dryrun = was_dryrun
@@ -90,7 +97,7 @@ class InstallPackages(Action):
                 return Script([partial(set_dryrun, True), *steps,
                                partial(set_dryrun, sh.dryrun)], name='setup')
 
-            return Script(steps, name='setup')
+            return Script([*steps, _packages_installed], name='setup')
 
 
 # Expose compiler via environment
@@ -135,5 +142,6 @@ class InstallCompiler(Action):
         for imp in imports:
             if imp.compiler:
                 imp.install(env)
+        _packages_installed(env)
 
         export_compiler(env.spec.compiler, env)
@@ -1,11 +1,17 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
+import argparse
 import os
 from builder.core.action import Action
+from builder.core.fetch import MIRROR_JOBS, mirror_packages
 from builder.core.project import Import
 
 
+def _overrides(imp, method):
+    return imp.__class__.__dict__.get(method, Import.__dict__[method]) != Import.__dict__[method]
+
+
 class Mirror(Action):
     """ Updates mirrored dependencies in S3/CloudFront """
 
@@ -13,11 +19,23 @@ class Mirror(Action):
         return True
 
     def run(self, env):
-        import_classes = Import.__subclasses__()
+        parser = argparse.ArgumentParser(prog='builder mirror')
+        parser.add_argument('--jobs', type=int, default=MIRROR_JOBS,
+                            help='Number of packages to download and upload at once')
+        args = parser.parse_known_args(env.args.args)[0]
 
-        for import_class in import_classes:
+        packages = []
+        for import_class in Import.__subclasses__():
             imp = import_class()
-            # only bother if the class actually implements mirror()
-            if imp.__class__.__dict__.get('mirror', Import.__dict__['mirror']) != Import.__dict__['mirror']:
+            # imports with their own mirror() are mirrored the old way, the rest are batched together
+            if _overrides(imp, 'mirror'):
                 print('Mirroring {}'.format(imp.name))
                 imp.mirror(env)
+            else:
+                urls = imp.package_urls()
+                if urls:
+                    print('Mirroring {}'.format(imp.name))
+                    packages += [(imp.name, url) for url in urls]
+
+        if packages:
+            mirror_packages(packages, jobs=args.jobs)
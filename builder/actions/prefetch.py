@@ -0,0 +1,148 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import shutil
+import tempfile
+from urllib.parse import urlparse
+
+from builder.core.action import Action
+from builder.core.fetch import fetch, get_manifest
+from builder.core.host import normalize_target
+from builder.core.project import Project
+from builder.core.spec import BuildSpec
+from builder.core.toolchain import _is_cross_compile
+from builder.actions.git import DownloadSource
+
+
+def _use_spec(project, spec, overrides=None):
+    """ Project configs are produced for one spec and then cached, so force a recompute for this one """
+    if project.config:
+        project.config['__processed'] = False
+    project.get_config(spec, overrides)
+
+
+def _compiler_imports(project, spec):
+    """
+    The compiler imports InstallCompiler adds to the project's own for spec (which include those of the spec's
+    compiler): dockcross, when cross compiling
+    """
+    if not project.get_config(spec).get('needs_compiler', True) or not _is_cross_compile(spec.target, spec.arch):
+        return []
+    return [Project.find_import('dockcross')]
+
+
+def _forget_projects(download_dir):
+    """ Projects cloned into download_dir are gone with it, so must not be found by the build """
+    download_dir = os.path.join(os.path.abspath(download_dir), '')
+    for name, project in list(Project._projects.items()):
+        if project.path and os.path.abspath(project.path).startswith(download_dir):
+            del Project._projects[name]
+
+
+def _fetch_package(url, download_dir):
+    # the point is to land the package in the cache, the downloaded copy is thrown away with download_dir
+    local_path = os.path.join(tempfile.mkdtemp(dir=download_dir), os.path.basename(urlparse(url).path))
+    fetch(url, local_path)
+
+
+class Prefetch(Action):
+    """
+    Downloads everything a build would, without building, so that later builds never wait on the network:
+        builder prefetch [--prefetch-spec SPEC]... [--prefetch-target TARGET]... [--jobs N]
+    The pre-built packages of the project's imports, its compiler's and its dependencies' go into the package cache,
+    and every upstream project (and consumer, for downstream specs) is fetched into ~/.builder/git-cache.
+    With no specs or targets, the spec being built is prefetched.
+    """
+
+    def is_main(self):
+        return True
+
+    def run(self, env):
+        parser = argparse.ArgumentParser(prog='builder prefetch')
+        parser.add_argument('--prefetch-spec', action='append', default=[],
+                            help='Spec to prefetch for, may be given more than once')
+        parser.add_argument('--prefetch-target', action='append', default=[],
+                            help='Target to prefetch for with the current spec, e.g. linux-armv8, may be given more than once')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of packages and repositories to fetch at once')
+        args = parser.parse_known_args(env.args.args)[0]
+
+        specs = [BuildSpec(spec=spec) for spec in args.prefetch_spec]
+        specs += [BuildSpec(spec=str(env.spec), target=normalize_target(target)) for target in args.prefetch_target]
+        if not specs:
+            specs = [env.spec]
+
+        overrides = getattr(env.args, 'cli_config', None)
+        self.packages = {}
+        download_dir = tempfile.mkdtemp(prefix='builder-prefetch-')
+        # load the manifest once, rather than racing to in every worker
+        get_manifest()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+                for spec in specs:
+                    print('Prefetching for {}'.format(spec))
+                    _use_spec(env.project, spec, overrides)
+                    self._prefetch_graph(env, spec, executor, download_dir)
+                wait(self.packages)
+        finally:
+            _forget_projects(download_dir)
+            shutil.rmtree(download_dir, ignore_errors=True)
+            # leave the project configured for the spec being built
+            _use_spec(env.project, env.spec, overrides)
+
+        failed = []
+        for future, url in self.packages.items():
+            if future.exception():
+                print('Failed to prefetch {}: {}'.format(url, future.exception()))
+                failed.append(url)
+        if failed:
+            raise Exception('Failed to prefetch {} of {} packages'.format(len(failed), len(self.packages)))
+
+    def _fetch_packages(self, imports, spec, executor, download_dir):
+        for imp in imports:
+            for url in imp.package_urls(spec):
+                if url not in self.packages.values():
+                    self.packages[executor.submit(_fetch_package, url, download_dir)] = url
+
+    def _prefetch_graph(self, env, spec, executor, download_dir):
+        """
+        Walks the project's upstream (and downstream) graph for spec. Projects not on disk are cloned through the
+        git cache into download_dir, which is how their own dependencies are discovered
+        """
+        seen = set()
+        clones = {}
+        projects = [env.project]
+        while projects or clones:
+            if not projects:
+                finished, _ = wait(clones, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    source = clones.pop(future)
+                    future.result()
+                    projects.append(Project.find_project(source.project.name, [download_dir]))
+                continue
+
+            project = projects.pop()
+            if project is not env.project:
+                _use_spec(project, spec)
+            imports = project.get_imports(spec)
+            if project is env.project:
+                imports = imports + _compiler_imports(project, spec)
+            self._fetch_packages(imports, spec, executor, download_dir)
+
+            deps = project.get_dependencies(spec)
+            if spec.downstream:
+                deps += project.get_consumers(spec)
+            for dep in deps:
+                if dep.name in seen:
+                    continue
+                seen.add(dep.name)
+                if dep.path:
+                    projects.append(dep)
+                    continue
+
+                branch = env.branch if dep.revision is None else dep.revision
+                source = DownloadSource(project=dep, branch=branch, path=download_dir, git_cache=True)
+                clones[executor.submit(source.clone, env, dep.name)] = source
@@ -21,7 +21,7 @@ def print_release_notes(env):
             sys.exit(1)
 
     def get_all_tags():
-        git_output = sh.exec('git', 'show-ref', '--tags', quiet=True).output
+        git_output = sh.exec('git', 'show-ref', '--tags', quiet=True, capture='full').output
         tags = []
         for line in git_output.splitlines():
             # line looks like: "e18f041a0c8d17189f2eae2a32f16e0a7a3f0f1c refs/tags/v0.5.18"
@@ -44,7 +44,7 @@ def print_release_notes(env):
                 return tag
 
     def get_current_commit():
-        git_output = sh.exec('git', 'rev-parse', 'HEAD', quiet=True).output
+        git_output = sh.exec('git', 'rev-parse', 'HEAD', quiet=True, capture='full').output
         return git_output.splitlines()[0]
 
     parser = argparse.ArgumentParser(
@@ -65,7 +65,7 @@ def print_release_notes(env):
     package_latest_tag = package_tags[0]
 
     package_changes = sh.exec(
-        'git', 'log', package_latest_tag['commit'] + '..', quiet=True).output
+        'git', 'log', package_latest_tag['commit'] + '..', quiet=True, capture='full').output
     if not package_changes:
         print('No changes since last release', package_latest_tag['str'])
         sys.exit(0)
@@ -77,7 +77,7 @@ class SetupCrossCICrtEnvironment(Action):
         try:
             cmd = ["aws", "--region", "us-east-1", "sts", "assume-role",
                    "--role-arn", role_arn, "--role-session", "CI_Test_Run"]
-            result = env.shell.exec(*cmd, check=True, quiet=True)
+            result = env.shell.exec(*cmd, check=True, quiet=True, capture='full')
             result_json = json.loads(result.output)
             self._setenv(env, env_name + "_ACCESS_KEY", result_json["Credentials"]["AccessKeyId"], is_secret=True)
             self._setenv(env, env_name + "_SECRET_ACCESS_KEY",
@@ -30,7 +30,7 @@ def create_windows_cert_store(env, certificate_env, location_env):
         "Import-PfxCertificate",
         "-FilePath", pfx_cert_path,
         "-CertStoreLocation", windows_certificate_folder]
-    import_result = env.shell.exec("powershell.exe", import_pfx_arguments, check=True)
+    import_result = env.shell.exec("powershell.exe", import_pfx_arguments, check=True, capture='full')
 
     # Get the certificate thumbprint from the output:
     import_pfx_output = str(import_result.output)
@@ -157,7 +157,7 @@ def _exec_softhsm2_util(env, *args, **kwargs):
     if not 'check' in kwargs:
         kwargs['check'] = True
 
-    result = env.shell.exec('softhsm2-util', *args, **kwargs)
+    result = env.shell.exec('softhsm2-util', *args, capture='full', **kwargs)
 
     # older versions of softhsm2-util (2.1.0 is a known offender)
     # return error code 0 and print the help if invalid args are passed.
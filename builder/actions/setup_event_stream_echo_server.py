@@ -51,8 +51,9 @@ class SetupEventStreamEchoServer(Action):
 
                 print(f'Echo server command: {echo_server_command}')
 
-                # bypass builder's exec wrapper since it doesn't allow for background execution
-                proc = subprocess.Popen(echo_server_command)
+                # bypass builder's exec wrapper since it doesn't allow for background execution,
+                # but run with the shell's environment, which os.environ no longer carries
+                proc = subprocess.Popen(echo_server_command, env=env.shell.environ())
 
                 @atexit.register
                 def _terminate_echo_server():
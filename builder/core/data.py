@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 from enum import Enum
-from builder.core.util import dict_alias
+from builder.core.util import cache_content_hashes, dict_alias
 
 ########################################################################################################################
 # DATA DEFINITIONS
@@ -777,3 +777,6 @@ for cc_arch in ['armv6', 'armv7', 'armv8']:
         for alias in ARCHS[cc_arch].get('aliases', []):
             alias_platform = '{}-{}'.format(cc_os, alias)
             PLATFORMS[alias_platform] = PLATFORMS[canonical_platform]
+
+# the data tables are never modified, so their content hashes are only computed once
+cache_content_hashes(HOSTS, TARGETS, COMPILERS, ARCHS, PLATFORMS)
@@ -37,7 +37,7 @@ class Env(object):
 
         # make sure the shell is initialized
         if not hasattr(self, 'shell'):
-            self.shell = Shell(self.dryrun)
+            self.shell = Shell(self.dryrun, log_file=getattr(self.args, 'log_file', None))
 
         # build environment set up
         self.launch_dir = os.path.abspath(self.shell.cwd())
@@ -117,8 +117,8 @@ class Env(object):
             self.deps_dir,
         ]
 
-        # set up build environment
-        if os.path.exists(self.build_dir):
+        # set up build environment, incremental builds reuse the previous build tree
+        if os.path.exists(self.build_dir) and not getattr(self.args, 'incremental', False):
             self.shell.rm(self.build_dir)
         self.shell.mkdir(self.build_dir)
 
@@ -1,16 +1,25 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 from hashlib import sha256
 import json
 import os
+import re
+import shutil
 import stat
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 import tarfile
 import zipfile
 from urllib.parse import urlparse
-from urllib.request import urlretrieve, urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 try:
     import fcntl
@@ -22,7 +31,7 @@ try:
 except:
     msvcrt = None
 
-from .util import run_command, chmod_exec
+from .util import run_command, run_commands, chmod_exec, where
 
 FETCH_URL = 'https://d19elf31gohf1l.cloudfront.net/_binaries'
 PUBLISH_URL = 's3://aws-crt-builder/_binaries'
@@ -34,20 +43,56 @@ MANIFEST_PATH = os.path.expanduser(os.path.join('~', '.builder', 'MANIFEST'))
 MANIFEST_LOCK = os.path.expanduser(
     os.path.join('~', '.builder', 'manifest.lock'))
 MANIFEST_TIMEOUT = 30
+# A copy of the remote manifest, which is trusted for BUILDER_MANIFEST_TTL seconds before being revalidated
+REMOTE_MANIFEST_PATH = os.path.expanduser(os.path.join('~', '.builder', 'REMOTE_MANIFEST'))
+MANIFEST_TTL = 600
 CACHE_DIR = os.path.expanduser(os.path.join('~', '.builder', 'pkg-cache'))
+# The least recently used packages are evicted from the cache to keep it under this size, in bytes,
+# or with a K/M/G suffix. Overridden by BUILDER_PKG_CACHE_MAX_SIZE
+CACHE_MAX_SIZE = '10G'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # linux ioctl to reflink a file
+# downloads at least this big, from servers that accept range requests, are fetched in concurrent ranges
+RANGED_DOWNLOAD_MIN_SIZE = 32 * 1024 * 1024
+RANGED_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+RANGED_DOWNLOAD_JOBS = 4
+RANGED_DOWNLOAD_RETRIES = 3
+MIRROR_JOBS = 4
+# archives that fetch_and_extract(cache=True) has extracted, by the digest of the archive
+EXTRACT_CACHE_DIR = os.path.expanduser(os.path.join('~', '.builder', 'extract-cache'))
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+# digests of the extracted trees this process has symlinked into place, which gc_cache must not remove
+_trees_in_use = set()
+
+
+# when offline, the local manifest and package cache are trusted, and nothing is downloaded
+_offline = False
+
+
+def set_offline(offline):
+    global _offline
+    _offline = offline
+
+
+def manifest_ttl():
+    """ Seconds that the cached remote manifest is used for without revalidation """
+    try:
+        return int(os.environ.get('BUILDER_MANIFEST_TTL', MANIFEST_TTL))
+    except ValueError:
+        return MANIFEST_TTL
 
 
 class LockFile(object):
-    def __init__(self, path=MANIFEST_LOCK, timeout=None):
-        self.path = path
+    def __init__(self, path=None, timeout=None):
+        self.path = path or MANIFEST_LOCK
         self.timeout = timeout
         self.fd = None
 
     def _lock(self):
         try:
-            fd = os.open(self.path, os.O_CREAT)
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
         except OSError:
-            pass
+            return
         try:
             if fcntl:
                 fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -64,6 +109,9 @@ class LockFile(object):
     def _unlock(self):
         fd = self.fd
         self.fd = None
+        if fd is None:
+            # timed out without getting the lock
+            return
 
         if fcntl:
             fcntl.flock(fd, fcntl.LOCK_UN)
@@ -97,16 +145,27 @@ class Manifest(object):
 
         manifest = self
 
-        class SynchronizedDict(dict):
+        class LocalManifest(dict):
+            """ Records changes, which are written to disk in one batch by flush() """
+
             def __setitem__(self, item, value):
                 super().__setitem__(item, value)
-                manifest.save()
+                with manifest._lock:
+                    manifest._pending[item] = value
+
+            def __delitem__(self, item):
+                super().__delitem__(item)
+                with manifest._lock:
+                    manifest._pending[item] = None
 
+        self._lock = threading.Lock()
+        self._pending = {}
         self.remote = Manifest._fetch_remote()
-        self.local = SynchronizedDict(Manifest._load_local())
+        self.local = LocalManifest(Manifest._load_local())
         if not os.path.isdir(CACHE_DIR):
             print('Creating package cache at {}'.format(CACHE_DIR))
             os.makedirs(CACHE_DIR)
+        atexit.register(self.flush)
 
     @staticmethod
     def _parse(doc):
@@ -119,27 +178,120 @@ class Manifest(object):
         return manifest
 
     @staticmethod
-    def _fetch_remote():
+    def _load_remote_cache():
         try:
-            with urlopen(FETCH_MANIFEST_URL) as manifest_doc:
-                return Manifest._parse(manifest_doc)
+            with open(REMOTE_MANIFEST_PATH, 'r') as cache_doc:
+                cached = json.load(cache_doc)
+            if isinstance(cached, dict) and isinstance(cached.get('manifest'), dict):
+                return cached
         except:
-            print('Unable to fetch manifest, operating without cache')
-            return {}
+            pass
+        return None
+
+    @staticmethod
+    def _save_remote_cache(cached):
+        try:
+            os.makedirs(os.path.dirname(REMOTE_MANIFEST_PATH), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(REMOTE_MANIFEST_PATH, os.getpid())
+            with open(tmp_path, 'w') as cache_doc:
+                json.dump(cached, cache_doc)
+            os.replace(tmp_path, REMOTE_MANIFEST_PATH)
+        except OSError as ex:
+            print('WARNING: Unable to cache remote manifest: {}'.format(ex))
+
+    @staticmethod
+    def _fetch_remote():
+        """
+        Returns the remote manifest. A copy is kept on disk, which is used without checking the server
+        for manifest_ttl() seconds, and after that revalidated with ETag/If-Modified-Since
+        """
+        cached = Manifest._load_remote_cache()
+        if _offline:
+            if cached is None:
+                print('Offline, and no remote manifest has been cached, only the local manifest will be used')
+                return {}
+            return cached['manifest']
+        if cached and time.time() - cached.get('fetched', 0) < manifest_ttl():
+            return cached['manifest']
+
+        request = Request(FETCH_MANIFEST_URL)
+        if cached:
+            if cached.get('etag'):
+                request.add_header('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.add_header('If-Modified-Since', cached['last_modified'])
+        try:
+            with urlopen(request) as manifest_doc:
+                manifest = json.load(manifest_doc)
+                cached = {
+                    'etag': manifest_doc.headers.get('ETag'),
+                    'last_modified': manifest_doc.headers.get('Last-Modified'),
+                    'manifest': manifest,
+                }
+        except HTTPError as ex:
+            if ex.code != 304 or not cached:
+                return Manifest._remote_unavailable(cached, ex)
+        except Exception as ex:
+            return Manifest._remote_unavailable(cached, ex)
+
+        # fresh, or revalidated
+        cached['fetched'] = time.time()
+        Manifest._save_remote_cache(cached)
+        return cached['manifest']
+
+    @staticmethod
+    def _remote_unavailable(cached, ex):
+        if cached:
+            print('Unable to fetch manifest ({}), using the copy cached {:.0f} minutes ago'.format(
+                ex, (time.time() - cached.get('fetched', 0)) / 60))
+            return cached['manifest']
+        print('Unable to fetch manifest ({}), operating without cache'.format(ex))
+        return {}
 
     @staticmethod
     def _load_local():
+        # the manifest is only ever replaced whole, so it can be read without locking
         try:
-            with LockFile(timeout=5):
-                with open(MANIFEST_PATH, 'r') as manifest_doc:
-                    return Manifest._parse(manifest_doc)
+            with open(MANIFEST_PATH, 'r') as manifest_doc:
+                return Manifest._parse(manifest_doc)
         except:
             return {}
 
+    def flush(self):
+        """
+        Merges the changes made since the last flush into the manifest on disk, along with any
+        changes other processes have written since it was loaded
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+            with LockFile(timeout=MANIFEST_TIMEOUT):
+                merged = Manifest._load_local()
+                for package, digest in pending.items():
+                    if digest is None:
+                        merged.pop(package, None)
+                    else:
+                        merged[package] = digest
+
+                # write to the side and swap in, so that readers never see a partial manifest
+                tmp_path = '{}.{}.tmp'.format(MANIFEST_PATH, os.getpid())
+                with open(tmp_path, 'w') as manifest_doc:
+                    json.dump(merged, manifest_doc)
+                os.replace(tmp_path, MANIFEST_PATH)
+        except OSError as ex:
+            print('WARNING: Unable to update package manifest {}: {}'.format(MANIFEST_PATH, ex))
+            return
+
+        # pick up what other processes have cached, without recording it as our own change
+        for package, digest in merged.items():
+            dict.__setitem__(self.local, package, digest)
+
     def save(self):
-        with LockFile(timeout=5):
-            with open(MANIFEST_PATH, 'w+') as manifest_doc:
-                json.dump(self.local, manifest_doc)
+        self.flush()
 
 
 _manifest = None
@@ -159,16 +311,95 @@ def _map_from_cache(url):
     package = _url_to_package(url)
 
     remote_digest = manifest.remote.get(package)
-    if remote_digest:
-        local_digest = manifest.local.get(package)
-        if local_digest == remote_digest:
+    local_digest = manifest.local.get(package)
+    # offline, whatever was last downloaded is trusted
+    if local_digest and (remote_digest or _offline):
+        if local_digest == remote_digest or _offline:
             cache_path = os.path.join(CACHE_DIR, local_digest)
             if os.path.isfile(cache_path):
+                _touch(cache_path)
                 return cache_path
 
     return url
 
 
+def _touch(path):
+    """ Marks a cache entry as used, the mtime of entries is their last access time for LRU eviction """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def parse_size(size):
+    """ Converts a size in bytes, or with a K/M/G/T suffix (e.g. 512M) to bytes """
+    m = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError('Invalid size: {}'.format(size))
+    return int(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2).upper() or ' ')
+
+
+def cache_max_size():
+    """ The size limit of the package cache in bytes """
+    return parse_size(os.environ.get('BUILDER_PKG_CACHE_MAX_SIZE', CACHE_MAX_SIZE))
+
+
+# size is the size of the package, tree_size the size of the tree it was extracted to (if any)
+CacheEntry = namedtuple('CacheEntry', ['digest', 'path', 'size', 'atime', 'tree_size'], defaults=[0])
+
+
+def cache_entries():
+    """ Returns the packages in the cache, least recently used first """
+    entries = []
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return entries
+    for name in names:
+        # in-flight inserts have a .tmp suffix, and are not entries yet
+        if not re.match(r'^[0-9a-f]{64}$', name):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append(CacheEntry(name, path, st.st_size, st.st_mtime, _tree_size(name)))
+    entries.sort(key=lambda entry: entry.atime)
+    return entries
+
+
+def gc_cache(max_size=None, keep=None):
+    """
+    Evicts the least recently used packages until the cache, including the trees extracted from its packages,
+    fits in max_size bytes (default: cache_max_size()). Trees extracted from evicted packages are removed too.
+    The entry named keep, and those whose trees this process has symlinked into place, are never evicted.
+    Returns the evicted entries
+    """
+    if max_size is None:
+        max_size = cache_max_size()
+    entries = cache_entries()
+    total = sum(entry.size + entry.tree_size for entry in entries)
+    evicted = []
+    for entry in entries:
+        if total <= max_size:
+            break
+        if entry.digest == keep or entry.digest in _trees_in_use:
+            continue
+        try:
+            remove_cache_entry(entry.path)
+        except FileNotFoundError:
+            # evicted by another process
+            pass
+        except OSError as ex:
+            print('WARNING: Unable to evict {} from package cache: {}'.format(entry.path, ex))
+            continue
+        _remove_tree(os.path.join(EXTRACT_CACHE_DIR, entry.digest))
+        total -= entry.size + entry.tree_size
+        evicted.append(entry)
+    return evicted
+
+
 def _url_to_package(url):
     return os.path.basename(urlparse(url).path)
 
@@ -180,98 +411,566 @@ def _is_cloudfront(url):
 def hash_file(file_path):
     hash = sha256()
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
             hash.update(chunk)
     return hash.hexdigest()
 
 
 def _download(url, local_path):
+    """
+    Downloads url to local_path, and returns the sha256 digest of its contents.
+    Large downloads from servers that support it are fetched in concurrent ranges, and can be resumed.
+    The download is written to the side, so local_path only ever appears complete
+    """
     print('Downloading {} to {}'.format(url, local_path))
-    slug = ''
     if _is_cloudfront(url):
         # add a unique param that will avoid the cache and pull from S3
-        slug = '?time={}'.format(time.time())
-    urlretrieve(url + slug, local_path)
+        url = '{}?time={}'.format(url, time.time())
+
+    info = _ranged_download_info(url)
+    if info:
+        return _download_ranges(url, local_path, info)
+    return _download_stream(url, local_path)
+
+
+def _download_stream(url, local_path):
+    """ Streams url to local_path, hashing it on the way """
+    tmp_path = local_path + '.part'
+    hash = sha256()
+    try:
+        with urlopen(url) as response, open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                hash.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return hash.hexdigest()
+
+
+def _ranged_download_info(url):
+    """ Returns the size and validator (ETag or Last-Modified) of url if it is worth downloading in ranges, or None """
+    if urlparse(url).scheme not in ('http', 'https'):
+        return None
+    try:
+        with urlopen(Request(url, method='HEAD')) as response:
+            headers = response.headers
+    except Exception:
+        return None
+    size = headers.get('Content-Length', '')
+    if headers.get('Accept-Ranges') != 'bytes' or not size.isdigit() or int(size) < RANGED_DOWNLOAD_MIN_SIZE:
+        return None
+    # If-Range only works with strong ETags
+    etag = headers.get('ETag')
+    validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+    return {'size': int(size), 'validator': validator}
+
+
+def _load_part_state(state_path, url, info):
+    """ Returns the indices of the chunks already downloaded, if the partial download is of the same file """
+    try:
+        with open(state_path, 'r') as state_doc:
+            state = json.load(state_doc)
+    except (OSError, ValueError):
+        return set()
+    # a partial download can only be resumed if it's of the same version of the same file
+    same = urlparse(state.get('url')).path == urlparse(url).path and state.get('size') == info['size'] \
+        and state.get('chunk_size') == RANGED_DOWNLOAD_CHUNK_SIZE and info['validator'] \
+        and state.get('validator') == info['validator']
+    return set(state.get('done', [])) if same else set()
+
+
+def _save_part_state(state_path, url, info, done):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as state_doc:
+        json.dump({'url': url, 'size': info['size'], 'validator': info['validator'],
+                   'chunk_size': RANGED_DOWNLOAD_CHUNK_SIZE, 'done': sorted(done)}, state_doc)
+    os.replace(tmp_path, state_path)
+
+
+def _partial_path(url):
+    """
+    Where a ranged download of url is assembled. Partial downloads are kept in the cache, keyed by url,
+    so they survive the deps dir being cleaned between runs
+    """
+    parsed = urlparse(url)
+    # the query is ignored, as cloudfront urls are made unique to avoid its cache
+    key = sha256('{}://{}{}'.format(parsed.scheme, parsed.netloc, parsed.path).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, 'partial', key + '.part')
+
+
+def _download_ranges(url, local_path, info):
+    """
+    Downloads url in RANGED_DOWNLOAD_CHUNK_SIZE ranges, RANGED_DOWNLOAD_JOBS at a time, into a preallocated
+    .part file in the cache. Completed ranges are recorded in a .part.json sidecar, so an interrupted download
+    resumes where it left off, even into a different local_path. Each range is retried on its own
+    """
+    tmp_path = _partial_path(url)
+    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+    # only one process can assemble a partial download at a time
+    with LockFile(tmp_path + '.lock'):
+        return _download_ranges_locked(url, local_path, info, tmp_path)
+
+
+def _download_ranges_locked(url, local_path, info, tmp_path):
+    size = info['size']
+    state_path = tmp_path + '.json'
+    chunks = [(start, min(start + RANGED_DOWNLOAD_CHUNK_SIZE, size) - 1)
+              for start in range(0, size, RANGED_DOWNLOAD_CHUNK_SIZE)]
+
+    done = _load_part_state(state_path, url, info) if os.path.isfile(tmp_path) else set()
+    if done:
+        print('Resuming download of {}, {} of {} ranges already downloaded'.format(url, len(done), len(chunks)))
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+        _save_part_state(state_path, url, info, done)
+    state_lock = threading.Lock()
+
+    def _fetch_chunk(index):
+        start, end = chunks[index]
+        request = Request(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        if info['validator']:
+            # if the file has changed, the server will send all of it rather than the range, which is rejected
+            request.add_header('If-Range', info['validator'])
+        for attempt in range(RANGED_DOWNLOAD_RETRIES + 1):
+            try:
+                with urlopen(request) as response, open(tmp_path, 'r+b') as f:
+                    if response.status != 206:
+                        raise Exception('Server ignored range request, status {}'.format(response.status))
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        data = response.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                        if not data:
+                            raise Exception('Connection closed with {} bytes of range {}-{} left'.format(
+                                remaining, start, end))
+                        f.write(data)
+                        remaining -= len(data)
+                break
+            except Exception as ex:
+                if attempt == RANGED_DOWNLOAD_RETRIES:
+                    raise
+                print('Retrying range {}-{} of {}: {}'.format(start, end, url, ex))
+                time.sleep(attempt + 1)
+        with state_lock:
+            done.add(index)
+            _save_part_state(state_path, url, info, done)
+
+    todo = [index for index in range(len(chunks)) if index not in done]
+    with ThreadPoolExecutor(max_workers=RANGED_DOWNLOAD_JOBS) as executor:
+        # leave the .part file and sidecar behind on failure, so the next attempt can resume
+        for future in [executor.submit(_fetch_chunk, index) for index in todo]:
+            future.result()
+
+    # ranges arrive out of order, so the digest is computed once they're all in (from the page cache)
+    digest = hash_file(tmp_path)
+    try:
+        os.replace(tmp_path, local_path)
+    except OSError:
+        # the cache is on a different filesystem
+        _copy_file(tmp_path, local_path)
+        os.remove(tmp_path)
+    os.remove(state_path)
+    return digest
+
+
+def _reflink_or_copy(src, dst):
+    """ Copies src to dst, sharing the data blocks (copy-on-write) if the filesystem supports it """
+    if fcntl and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            # not supported by this filesystem, or src and dst are on different ones
+            pass
+    shutil.copyfile(src, dst)
+
+
+def _copy_file(src, dst, read_only=False):
+    """
+    Atomically makes dst a private copy of src, sharing the data blocks (copy-on-write) if the filesystem
+    supports it. The copy is writable unless read_only is set
+    """
+    tmp_path = '{}.{}-{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+    try:
+        _reflink_or_copy(src, tmp_path)
+        mode = stat.S_IMODE(os.stat(src).st_mode)
+        os.chmod(tmp_path, mode & ~_WRITE_BITS if read_only else mode | stat.S_IWUSR)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _link_file(src, dst, read_only=False):
+    """
+    Atomically makes dst a hard link to src, falling back to a (copy-on-write, where possible) copy when
+    they're on different filesystems, or the filesystem can't link. If read_only is set, the file is made
+    read-only first, which a link shares with src
+    """
+    if sys.platform == 'win32':
+        # windows won't remove a read-only link, and making it writable would unseal every other link to it
+        _copy_file(src, dst, read_only=read_only)
+        return
+    if read_only:
+        os.chmod(src, stat.S_IMODE(os.stat(src).st_mode) & ~_WRITE_BITS)
+    tmp_path = '{}.{}-{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        _copy_file(src, dst, read_only=read_only)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _add_to_cache(path, digest):
+    """
+    Links path into the cache as digest, atomically, so the download isn't copied again. Entries are
+    read-only, which makes path read-only too: it must be replaced, never changed in place (see fetch)
+    """
+    cache_path = os.path.join(CACHE_DIR, digest)
+    if os.path.isfile(cache_path):
+        _touch(cache_path)
+        return cache_path
+    _link_file(path, cache_path, read_only=True)
+    return cache_path
+
+
+def _make_private(path):
+    """ Replaces path, if it's linked to a cache entry, with a writable copy of its own """
+    if os.stat(path).st_nlink > 1 or not os.access(path, os.W_OK):
+        _copy_file(path, path)
+
+
+def remove_cache_entry(path):
+    """ Removes a (read-only) package from the cache """
+    if sys.platform == 'win32':
+        # read-only files can't be removed on windows
+        os.chmod(path, stat.S_IWRITE)
+    os.remove(path)
 
 
 def fetch(url, local_path, skip_cache=False):
-    """ Download a file from a url and store it locally """
-    # if it's already mapped to a local file, just let urlretrieve do the copy
+    """
+    Download a file from a url and store it locally, returning its sha256 digest.
+    Unless skip_cache is set, the download must match the digest in the remote manifest, if there is one.
+    local_path is usually a hard link to the read-only cache entry, so it must be replaced, or made private
+    with _make_private, rather than changed in place
+    """
+    # if it's already in the cache, link it from there
     if not skip_cache:
-        url = _map_from_cache(url)
-        if os.path.isfile(url):
-            print('Using cached package {}'.format(url))
-            return urlretrieve('file://' + url, local_path)
+        cache_path = _map_from_cache(url)
+        if os.path.isfile(cache_path):
+            print('Using cached package {}'.format(cache_path))
+            local_dir = os.path.dirname(os.path.abspath(local_path))
+            if not os.path.isdir(local_dir):
+                os.makedirs(local_dir)
+            try:
+                _link_file(cache_path, local_path)
+                return os.path.basename(cache_path)
+            except FileNotFoundError:
+                # evicted by another process's gc since it was looked up
+                print('Cached package {} was evicted, downloading it again'.format(cache_path))
+    if _offline:
+        raise Exception('Unable to fetch {}, it is not in the package cache and builder is offline'.format(url))
 
     manifest = get_manifest()
-    digest = manifest.remote.get(url)
+    package = _url_to_package(url)
 
     local_dir = os.path.dirname(local_path)
     if not os.path.isdir(local_dir):
         os.makedirs(local_dir)
 
-    _download(url, local_path)
+    digest = _download(url, local_path)
+    expected_digest = manifest.remote.get(package)
+    if expected_digest and digest != expected_digest and not skip_cache:
+        os.remove(local_path)
+        raise Exception('Downloaded {} has sha256 {}, but the manifest expects {}'.format(
+            url, digest, expected_digest))
 
     # move to cache, record digest
     try:
-        if not digest:
-            digest = hash_file(local_path)
-        cache_path = os.path.join(CACHE_DIR, digest)
-        urlretrieve('file://' + local_path, cache_path)
+        cache_path = _add_to_cache(local_path, digest)
         print('Cached {} to {}'.format(local_path, cache_path))
-        package = _url_to_package(url)
         manifest.local[package] = digest
+        for entry in gc_cache(keep=digest):
+            print('Evicted {} from package cache'.format(entry.path))
     except Exception as ex:
-        print('WARNING: failed to cache {} to {}: {}'.format(
-            local_path, cache_path, ex))
+        print('WARNING: failed to cache {}: {}'.format(local_path, ex))
+    return digest
+
+
+# magic numbers of compressed tarballs, and the external tools that can decompress them faster than python,
+# in order of preference. zstd can't be decompressed by python at all
+_DECOMPRESSORS = [
+    (b'\x1f\x8b', ['pigz']),  # gzip
+    (b'\x28\xb5\x2f\xfd', ['zstd']),  # zstd
+]
+
+
+def _external_decompressor(archive_path):
+    """ Returns a command line that decompresses archive_path to stdout, or None if python should do it """
+    with open(archive_path, 'rb') as archive:
+        magic = archive.read(4)
+    for prefix, tools in _DECOMPRESSORS:
+        if magic.startswith(prefix):
+            for tool in tools:
+                tool_path = where(tool)
+                if tool_path:
+                    return [tool_path, '-d', '-c', archive_path]
+    return None
+
+
+def _is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def _check_member(member, path):
+    """ Rejects members that would be written, or link, outside of path """
+    if not _is_within_directory(path, os.path.join(path, member.name)):
+        raise Exception("Attempted Path Traversal in Tar File")
+    if member.issym() and not _is_within_directory(
+            path, os.path.join(path, os.path.dirname(member.name), member.linkname)):
+        raise Exception("Attempted Path Traversal in Tar File")
+    if member.islnk() and not _is_within_directory(path, os.path.join(path, member.linkname)):
+        raise Exception("Attempted Path Traversal in Tar File")
+    return member
+
+
+def _extract_tar(tar, path):
+    """ Extracts a tarfile opened in stream mode, checking each member as it goes, in a single pass """
+    # python 3.12+ (and security releases of earlier versions) have the 'data' filter, which also strips
+    # dangerous permissions and special files. Otherwise, just check for path traversal
+    data_filter = getattr(tarfile, 'data_filter', None)
+    extract_args = {'filter': 'fully_trusted'} if data_filter else {}
+
+    # directory permissions and times are applied at the end, like extractall, in case they're read-only
+    directories = []
+    for member in tar:
+        member = data_filter(member, path) if data_filter else _check_member(member, path)
+        if member is None:
+            continue
+        if member.isdir():
+            directories.append(member)
+            tar.extract(member, path, set_attrs=False, **extract_args)
+        else:
+            tar.extract(member, path, **extract_args)
 
+    directories.sort(key=lambda member: member.name, reverse=True)
+    for member in directories:
+        dir_path = os.path.join(path, member.name)
+        try:
+            tar.chown(member, dir_path, False)
+            tar.utime(member, dir_path)
+            tar.chmod(member, dir_path)
+        except tarfile.ExtractError as ex:
+            print('WARNING: Unable to set attributes of {}: {}'.format(dir_path, ex))
 
-def fetch_and_extract(url, archive_path, extract_path):
-    """ Download a tarball or zip file and extract it """
-    fetch(url, archive_path)
 
+def _extract(archive_path, extract_path):
     if not os.path.isdir(extract_path):
         os.makedirs(extract_path)
 
     print('Extracting {} to {}'.format(archive_path, extract_path))
-    if tarfile.is_tarfile(archive_path):
-        with tarfile.open(archive_path) as tar:
-            def is_within_directory(directory, target):
+    decompressor = _external_decompressor(archive_path)
+    if decompressor:
+        # decompress in another process, in parallel with extraction
+        proc = subprocess.Popen(decompressor, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                _extract_tar(tar, extract_path)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise Exception('{} exited with code {}'.format(' '.join(decompressor), returncode))
+
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path, mode='r|*') as tar:
+            _extract_tar(tar, extract_path)
 
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
+    elif zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zip:
+            zip.extractall(extract_path)
 
-                prefix = os.path.commonprefix([abs_directory, abs_target])
+    else:
+        print('Unrecognized archive {}, cannot extract'.format(archive_path))
 
-                return prefix == abs_directory
 
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
+def _tree_size(digest):
+    """ The size of the tree extracted from the package with the given digest, or 0 if there isn't one """
+    try:
+        with open(os.path.join(EXTRACT_CACHE_DIR, digest + '.size')) as size_file:
+            return int(size_file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def _seal_tree(tree):
+    """ Makes every file and directory in tree read-only, so that users of the shared tree can't modify it. Returns its size """
+    size = 0
+    for root, dirs, files in os.walk(tree, topdown=False):
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+            os.chmod(path, stat.S_IMODE(st.st_mode) & ~_WRITE_BITS)
+    os.chmod(tree, stat.S_IMODE(os.stat(tree).st_mode) & ~_WRITE_BITS)
+    return size
+
+
+def _remove_tree(tree):
+    """ Removes a (possibly sealed) extracted tree, and its size record """
+    for root, dirs, files in os.walk(tree):
+        # read-only directories can't be emptied, and read-only files can't be removed on windows
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                try:
+                    os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IWUSR)
+                except OSError:
+                    pass
+    try:
+        os.chmod(tree, stat.S_IMODE(os.stat(tree).st_mode) | stat.S_IWUSR)
+    except OSError:
+        pass
+    shutil.rmtree(tree, ignore_errors=True)
+    try:
+        os.remove(tree + '.size')
+    except OSError:
+        pass
 
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
 
-                tar.extractall(path, members, numeric_owner=numeric_owner)
+def _extracted_tree(archive_path, digest):
+    """ Returns the shared, read-only tree that the archive with the given digest extracts to, extracting it if need be """
+    tree = os.path.join(EXTRACT_CACHE_DIR, digest)
+    if os.path.isdir(tree):
+        return tree
 
-            safe_extract(tar, extract_path)
+    # extract to the side, so that an interrupted extraction never looks like a valid tree
+    tmp_tree = '{}.{}-{}.tmp'.format(tree, os.getpid(), threading.get_ident())
+    try:
+        _extract(archive_path, tmp_tree)
+        size = _seal_tree(tmp_tree)
+        try:
+            os.rename(tmp_tree, tree)
+        except OSError:
+            # another process extracted it first
+            if not os.path.isdir(tree):
+                raise
+        else:
+            # the tree counts towards the size of the cache
+            tmp_size = '{}.size.{}-{}.tmp'.format(tree, os.getpid(), threading.get_ident())
+            with open(tmp_size, 'w') as size_file:
+                size_file.write(str(size))
+            os.replace(tmp_size, tree + '.size')
+    finally:
+        if os.path.isdir(tmp_tree):
+            _remove_tree(tmp_tree)
+    return tree
+
+
+def _copy_tree(src, dst):
+    """ Copies src into dst, preserving symlinks. Unlike the sealed src, the copy is writable """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        os.chmod(target, stat.S_IMODE(os.stat(root).st_mode) | stat.S_IWUSR)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            dst_path = os.path.join(target, name)
+            if os.path.islink(path):
+                if os.path.lexists(dst_path):
+                    os.remove(dst_path)
+                os.symlink(os.readlink(path), dst_path)
+            elif name in files:
+                _copy_file(path, dst_path)
+        # os.walk doesn't descend into symlinks to directories, which have been copied as links
+        dirs[:] = [name for name in dirs if not os.path.islink(os.path.join(root, name))]
+
+
+def _link_tree(tree, extract_path, link):
+    """
+    Makes the contents of tree appear in extract_path via symlinks if link is set, otherwise via copies.
+    Copies are reflinked where the filesystem supports it, and never share inodes with the tree, so are safe to modify
+    """
+    if not os.path.isdir(extract_path):
+        os.makedirs(extract_path)
 
-    elif zipfile.is_zipfile(archive_path):
-        with zipfile.ZipFile(archive_path) as zip:
-            zip.extractall(extract_path)
+    for name in os.listdir(tree):
+        src = os.path.join(tree, name)
+        dst = os.path.join(extract_path, name)
+        if link and (os.path.islink(dst) or not os.path.exists(dst)):
+            try:
+                if os.path.islink(dst):
+                    os.remove(dst)
+                os.symlink(src, dst, target_is_directory=os.path.isdir(src))
+                # the tree must outlive this process's use of it
+                _trees_in_use.add(os.path.basename(tree))
+                continue
+            except OSError:
+                # no symlink support (e.g. windows without developer mode), fall back to copying
+                pass
+        if os.path.isdir(src) and not os.path.islink(src):
+            _copy_tree(src, dst)
+        else:
+            _copy_file(src, dst)
 
-    else:
-        print('Unrecognized archive {}, cannot extract'.format(archive_path))
+
+def fetch_and_extract(url, archive_path, extract_path, cache=False, link=True):
+    """
+    Download a tarball or zip file and extract it.
+    If cache is set, the archive is extracted once per host into a tree under EXTRACT_CACHE_DIR, and the top
+    level entries of that tree are symlinked into extract_path. The tree is shared, so must not be modified.
+    If the tree must be visible without following symlinks out of extract_path (e.g. when it is mounted into
+    a container), set link to False, and the tree will be copied (reflinked, where possible) into extract_path instead
+    """
+    digest = fetch(url, archive_path)
+
+    if cache and digest:
+        try:
+            tree = _extracted_tree(archive_path, digest)
+        except Exception as ex:
+            print('WARNING: Unable to cache extracted {}: {}'.format(archive_path, ex))
+        else:
+            print('Using extracted {} from {}'.format(archive_path, tree))
+            _link_tree(tree, extract_path, link)
+            return
+
+    _extract(archive_path, extract_path)
 
 
 def fetch_script(url, script_path):
     """ Download a script, and give it executable permissions """
     fetch(url, script_path)
+    # the only fetched file that's changed in place, so the only one that needs its own copy
+    _make_private(script_path)
 
     print('Applying exec permissions to {}'.format(script_path))
     chmod_exec(script_path)
 
 
+def _publish_manifest(manifest):
+    print('Updating remote manifest')
+    with tempfile.NamedTemporaryFile('w+', delete=False) as tmp_manifest:
+        json.dump(manifest.remote, tmp_manifest)
+        tmp_manifest.close()
+        run_command('aws', 's3', 'cp', tmp_manifest.name, PUBLISH_MANIFEST_URL)
+    os.remove(tmp_manifest.name)
+
+
 def publish_package(name, package_path):
     manifest = get_manifest()
     package = os.path.basename(package_path)
@@ -281,19 +980,62 @@ def publish_package(name, package_path):
     s3_url = PACKAGE_URL_FORMAT.format(
         url=PUBLISH_URL, name=name, package=package)
     run_command('aws', 's3', 'cp', package_path, s3_url)
+    _publish_manifest(manifest)
 
-    print('Updating remote manifest')
-    # Update hash for this file in the manifest
-    with tempfile.NamedTemporaryFile('w+', delete=False) as tmp_manifest:
-        json.dump(manifest.remote, tmp_manifest)
-        tmp_manifest.close()
-        run_command('aws', 's3', 'cp', tmp_manifest.name, PUBLISH_MANIFEST_URL)
+
+def mirror_packages(packages, jobs=MIRROR_JOBS):
+    """
+    Mirror (name, source_url) pairs to S3, jobs at a time. Each distinct url is downloaded once, packages whose
+    digest already matches the remote manifest are not uploaded again, and identical files published under
+    different names are copied within S3 rather than uploaded twice. The remote manifest is uploaded once, at the end
+    """
+    jobs = max(1, jobs)
+    manifest = get_manifest()
+    packages = list(dict.fromkeys(packages))
+    urls = list(dict.fromkeys(url for _, url in packages))
+
+    download_dir = tempfile.mkdtemp(prefix='builder-mirror-')
+    try:
+        def download(idx, url):
+            # urls can share a filename, so each gets its own directory
+            local_path = os.path.join(download_dir, str(idx), _url_to_package(url))
+            return local_path, fetch(url, local_path, skip_cache=True)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            downloads = dict(zip(urls, pool.map(download, range(len(urls)), urls)))
+
+        # the manifest is keyed by filename, so compare against it as it was before this run
+        remote = dict(manifest.remote)
+        uploads = []
+        copies = []
+        published = {}
+        for name, url in packages:
+            package = _url_to_package(url)
+            local_path, digest = downloads[url]
+            s3_url = PACKAGE_URL_FORMAT.format(url=PUBLISH_URL, name=name, package=package)
+            if remote.get(package) == digest:
+                print('{} is already mirrored, skipping'.format(s3_url))
+                continue
+            if digest in published:
+                copies.append(['aws', 's3', 'cp', published[digest], s3_url])
+            else:
+                uploads.append(['aws', 's3', 'cp', local_path, s3_url])
+                published[digest] = s3_url
+            manifest.remote[package] = digest
+
+        if not uploads and not copies:
+            print('All packages are already mirrored')
+            return
+
+        print('Publishing {} packages to S3'.format(len(uploads) + len(copies)))
+        # copies are sourced from this run's uploads, so they have to wait for them. Both run jobs at a time
+        for commands in (uploads, copies):
+            for start in range(0, len(commands), jobs):
+                run_commands(commands[start:start + jobs], check=True)
+        _publish_manifest(manifest)
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
 
 
 def mirror_package(name, source_url):
-    url_path = urlparse(source_url).path
-    filename = os.path.basename(url_path)
-    local_path = os.path.join(tempfile.gettempdir(), filename)
-    # This will also shove the file into the cache
-    fetch(source_url, local_path, skip_cache=True)
-    publish_package(name, local_path)
+    mirror_packages([(name, source_url)])
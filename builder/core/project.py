@@ -5,12 +5,17 @@ import glob
 import os
 import sys
 from collections import namedtuple
+from collections.abc import Mapping
+from enum import Enum
 from functools import partial
 
 from builder.core.data import *
+from builder.core.fetch import mirror_packages
 from builder.core.host import current_os, package_tool
 from builder.core.scripts import Scripts
-from builder.core.util import replace_variables, merge_unique_attrs, to_list, tree_transform, isnamedtuple, UniqueList
+from builder.core.spec import BuildSpec
+from builder.core.util import replace_variables, merge_unique_attrs, to_list, tree_transform, isnamedtuple, UniqueList, \
+    VariableIndex
 from builder.actions.cmake import CMakeBuild, CTestRun
 from builder.actions.script import Script
 
@@ -86,8 +91,133 @@ def _arch_aliases(spec):
     return aliases
 
 
+# produced configs, keyed by a frozen copy of everything produce_config reads
+_config_cache = {}
+_CONFIG_CACHE_SIZE = 256
+
+
+def _freeze(value):
+    """
+    Returns an immutable, hashable copy of a config input. Only plain data, and the references and specs made
+    from it, can be frozen: anything else (Projects, Imports, steps, functions) raises TypeError
+    """
+    value_type = type(value)
+    if value_type is str or value_type is int or value is None:
+        return value
+    if value_type is bool or value_type is float:
+        # True == 1 == 1.0, but they don't render the same
+        return (value_type, value)
+    if isinstance(value, Enum):
+        # e.g. PKG_TOOLS, members are immutable singletons
+        return value
+    if value_type is dict:
+        return (dict, tuple((_freeze(k), _freeze(v)) for k, v in value.items()))
+    if value_type is list or value_type is tuple:
+        return (value_type, tuple(_freeze(v) for v in value))
+    if value_type is ProjectReference:
+        return (ProjectReference, value.name, _freeze(getattr(value, 'targets', None)), _freeze(value.config))
+    if isnamedtuple(value) and value_type.__name__ == 'ImportReference' and value.resolved is _not_resolved:
+        return ('ImportReference', value.name)
+    if value_type is _LazyVariants:
+        # variants are always produced from their sources and published variables, so that's all that matters
+        return (_LazyVariants, _freeze(value.sources), _freeze(value.published))
+    if value_type is BuildSpec:
+        # the name isn't updated when the compiler is resolved, so use the fields it's made from
+        return (BuildSpec, value.host, value.target, value.arch, value.compiler, value.compiler_version,
+                value.downstream)
+    raise TypeError('{} can not be part of a config cache key'.format(value_type.__qualname__))
+
+
+def _config_key(*parts):
+    try:
+        return _freeze(parts)
+    except TypeError:
+        # configs made from objects rather than data just aren't cached
+        return None
+
+
+def _copy_config(value):
+    """ Copies the dicts and lists of a config, sharing everything else """
+    if isinstance(value, _LazyVariants):
+        return value.copy()
+    if type(value) == dict:
+        return {k: _copy_config(v) for k, v in value.items()}
+    if type(value) == list:
+        return [_copy_config(v) for v in value]
+    return value
+
+
+# Stands in for a project when producing variants, so they see its config as it was when they were declared
+_ConfigSource = namedtuple('_ConfigSource', ['config'])
+
+
+class _LazyVariants(Mapping):
+    """
+    The variants of a produced config. Each is only produced when it is looked up, at most once.
+    Variables published before then are applied to it when it is produced
+    """
+
+    def __init__(self, sources, build_spec, project, additional_variables, published=None):
+        self.sources = sources
+        self.published = list(published or [])
+        self._build_spec = build_spec
+        self._project = project
+        self._additional_variables = additional_variables
+        self._resolved = {}
+
+    def __getitem__(self, name):
+        if name not in self._resolved:
+            variant = produce_config(self._build_spec, self._project, None,
+                                     self.sources[name], **self._additional_variables)
+            for variables in self.published:
+                variant = replace_variables(variant, variables)
+            self._resolved[name] = variant
+        return self._resolved[name]
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def publish(self, variables):
+        for name, variant in self._resolved.items():
+            self._resolved[name] = replace_variables(variant, variables)
+        self.published.append(variables)
+
+    def copy(self):
+        variants = _LazyVariants(self.sources, self._build_spec, self._project, self._additional_variables,
+                                 self.published)
+        variants._resolved = {name: _copy_config(variant) for name, variant in self._resolved.items()}
+        return variants
+
+
 def produce_config(build_spec, project, overrides=None, variant_config=None, **additional_variables):
-    """ Traverse the configurations to produce one for the given spec """
+    """
+    Traverse the configurations to produce one for the given spec. Configs are memoized on their inputs,
+    and each caller gets its own copy to modify
+    """
+    key = _config_key(build_spec, current_os(), os.getcwd(), project.config, overrides, variant_config,
+                      additional_variables)
+    config = _config_cache.get(key) if key else None
+    if config is None:
+        config = _produce_config(build_spec, project, overrides, variant_config, **additional_variables)
+        if key:
+            if len(_config_cache) >= _CONFIG_CACHE_SIZE:
+                del _config_cache[next(iter(_config_cache))]
+            # configs share lists and dicts with their inputs, so keep a copy that can't change under the cache
+            _config_cache[key] = _copy_config(config)
+        return config
+    return _copy_config(config)
+
+
+def _produce_config(build_spec, project, overrides=None, variant_config=None, **additional_variables):
     host_os = current_os()
 
     defaults = {
@@ -227,14 +357,14 @@ def produce_config(build_spec, project, overrides=None, variant_config=None, **a
     new_version = replace_variables(new_version, replacements)
     new_version['variables'] = replacements
 
-    # resolve build variants for the top level config
+    # build variants for the top level config are only resolved if they are asked for
     if not variant_config:
         variants = project_config.get('variants', {})
-        resolved_variants = {}
-        for name, variant_config in variants.items():
-            variant = produce_config(build_spec, project, None, variant_config, **additional_variables)
-            resolved_variants[name] = variant
-        new_version['variants'] = resolved_variants
+        published = []
+        if isinstance(variants, _LazyVariants):
+            variants, published = variants.sources, variants.published
+        source = _ConfigSource(_copy_config(project_config) if variants else None)
+        new_version['variants'] = _LazyVariants(variants, build_spec, source, additional_variables, published)
 
     new_version['__processed'] = True
 
@@ -443,8 +573,17 @@ class Import(object):
         self.imports = _resolve_imports_for_spec(getattr(self, 'imports', []) + self.config.get('imports', []), spec)
         return self.imports
 
+    def package_urls(self, spec=None):
+        """
+        The urls of the pre-built packages this import installs for spec, or for every spec if spec is None.
+        The mirror action publishes these to S3, and the prefetch action downloads them into the package cache
+        """
+        return []
+
     def mirror(self, env):
-        pass
+        urls = self.package_urls()
+        if urls:
+            mirror_packages([(self.name, url) for url in urls])
 
 
 class Project(object):
@@ -464,6 +603,7 @@ class Project(object):
         self.revision = kwargs.get('revision', None)
 
         self.variant = None
+        self._variable_index = None
 
         _transform_refs(kwargs)
 
@@ -484,6 +624,7 @@ class Project(object):
 
     def resolve(self, path):
         self.path = path
+        self._variable_index = None
 
         # replace project specific variables now that we can
         replacements = {
@@ -713,7 +854,14 @@ class Project(object):
     @staticmethod
     def _publish_variable(var, value):
         for project in Project._projects.values():
-            project.config = replace_variables(project.config, {var: value})
+            # only the strings that reference var are re-rendered
+            index = getattr(project, '_variable_index', None)
+            if index is None or index.tree is not project.config:
+                index = project._variable_index = VariableIndex(project.config)
+            index.publish(var, value)
+            variants = project.config.get('variants')
+            if isinstance(variants, _LazyVariants):
+                variants.publish({var: value})
 
     @staticmethod
     def _find_project_class(name):
@@ -0,0 +1,69 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def _topological_order(nodes, dependencies):
+    """ Orders nodes such that every node comes after all of its dependencies, preserving the given order otherwise """
+    order = []
+    visited = set()
+
+    def _visit(node):
+        if node in visited:
+            return
+        visited.add(node)
+        for dep in dependencies(node):
+            _visit(dep)
+        order.append(node)
+
+    for node in nodes:
+        _visit(node)
+    return order
+
+
+def run_graph(nodes, dependencies, fn, jobs=1):
+    """
+    Runs fn(node) for every node in a dependency graph. A node is only started once all of its
+    dependencies have finished. Up to jobs nodes are run concurrently, independent nodes are started
+    in the order given. With jobs <= 1, nodes are run serially on the calling thread.
+    If any node fails, no new nodes are started and the first exception is re-raised once
+    all running nodes have finished.
+    :param nodes: list of hashable nodes
+    :param dependencies: fn(node) -> iterable of nodes which must complete before node runs
+    :param fn: fn(node) to run for each node
+    """
+    order = _topological_order(nodes, dependencies)
+    if jobs <= 1 or len(order) <= 1:
+        for node in order:
+            fn(node)
+        return
+
+    pending = {node: set(dependencies(node)) for node in order}
+    done = set()
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if error is None:
+                ready = [node for node in order if node in pending and pending[node] <= done]
+                for node in ready[:jobs - len(running)]:
+                    del pending[node]
+                    running[executor.submit(fn, node)] = node
+            elif not running:
+                break
+
+            if not running:
+                raise Exception('Dependency cycle detected between: {}'.format(', '.join(map(str, pending))))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    done.add(node)
+
+    if error is not None:
+        raise error
@@ -5,6 +5,7 @@ import json
 import os
 import shutil
 import tempfile
+import threading
 
 from builder.core.host import current_os
 from builder.core import util
@@ -13,14 +14,22 @@ from builder.core import util
 class Shell(object):
     """ Virtual shell that abstracts away dry run and tracks/logs state """
 
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, log_file=None):
         # Used in dry-run builds to track simulated working directory
         self._cwd = os.getcwd()
         # pushd/popd stack
         self.dir_stack = []
-        self.env_stack = []
+        # environment overlays, each holding only the variables set while it was on top. The bottom
+        # frame can never be popped. Commands get the process environment with every frame applied
+        self.env_stack = [{}]
+        self._merged_env = None
+        self._env_lock = threading.RLock()
         self.dryrun = dryrun
         self.platform = current_os()
+        # if set, output of all commands is appended to this file
+        self.log_file = os.path.abspath(log_file) if log_file else None
+        # in-process lookups (e.g. toolchain discovery) see this shell's environment, not just os.environ
+        util.set_environ_provider(self._environ)
 
     def _cd(self, directory):
         if self.dryrun:
@@ -73,26 +82,50 @@ class Shell(object):
         else:
             return os.getcwd()
 
+    def _env_key(self, var):
+        # environment variable names are case insensitive on windows, and os.environ upper cases them
+        return var.upper() if self.platform == 'windows' else var
+
     def setenv(self, var, value, is_secret=False, **kwargs):
-        """ Set an environment variable """
+        """ Set an environment variable for all subsequent commands. The process environment is not modified """
         if not kwargs.get('quiet', False):
             if is_secret:
                 util.log_command(["export", "{}=***".format(var)])
             else:
                 util.log_command(["export", "{}={}".format(var, value)])
         if not self.dryrun:
-            os.environ[var] = str(value)
+            with self._env_lock:
+                self.env_stack[-1][self._env_key(var)] = str(value)
+                self._merged_env = None
+            if self._env_key(var) == self._env_key('PATH'):
+                util.invalidate_where_cache()
 
     def getenv(self, var, default=None):
         """ Get an environment variable """
-        try:
-            return os.environ[var]
-        except:
-            return default
+        var = self._env_key(var)
+        with self._env_lock:
+            for frame in reversed(self.env_stack):
+                if var in frame:
+                    return frame[var]
+        return os.environ.get(var, default)
+
+    def environ(self):
+        """ Returns a copy of the environment that commands run with """
+        return dict(self._environ())
+
+    def _environ(self):
+        """ The process environment with every frame on the stack applied, cached until the stack changes """
+        with self._env_lock:
+            if self._merged_env is None:
+                merged = dict(os.environ)
+                for frame in self.env_stack:
+                    merged.update(frame)
+                self._merged_env = merged
+            return self._merged_env
 
     def addpathenv(self, var, path, **kwargs):
         """Add a path to an environment variable"""
-        prev = os.getenv(var)
+        prev = self.getenv(var)
         if prev:
             value = prev + os.pathsep + path
         else:
@@ -100,23 +133,24 @@ class Shell(object):
         self.setenv(var, value, **kwargs)
 
     def pushenv(self, **kwargs):
-        """ Store the current environment on a stack, for restoration later """
+        """ Start a new environment frame, so that variables set from now on can be discarded by popenv """
         if not kwargs.get('quiet', False):
             util.log_command(['pushenv'])
-        self.env_stack.append(dict(os.environ))
+        with self._env_lock:
+            self.env_stack.append({})
 
     def popenv(self, **kwargs):
-        """ Restore the environment to the state on the top of the stack """
+        """ Discard every variable set since the matching pushenv """
         if not kwargs.get('quiet', False):
             util.log_command(['popenv'])
-        env = self.env_stack.pop()
-        # clear out values that won't be overwritten
-        for name, value in dict(os.environ).items():
-            if name not in env:
-                del os.environ[name]
-        # write the old env
-        for name, value in env.items():
-            os.environ[name] = value
+        with self._env_lock:
+            if len(self.env_stack) == 1:
+                raise IndexError('popenv called without a matching pushenv')
+            frame = self.env_stack.pop()
+            if frame:
+                self._merged_env = None
+        if self._env_key('PATH') in frame:
+            util.invalidate_where_cache()
 
     def rm(self, path, **kwargs):
         """ Remove a file or directory """
@@ -129,10 +163,13 @@ class Shell(object):
                 print("Failed to delete dir {}: {}".format(path, e))
 
     def where(self, exe, path=None, resolve_symlinks=True, **kwargs):
-        """ Platform agnostic `where executable` command """
+        """ Platform agnostic `where executable` command, searching the PATH that commands run with """
+        if path is None:
+            path = self.getenv('PATH')
         return util.where(exe, path, resolve_symlinks)
 
-    def exec(self, *command, check=False, quiet=False, always=False, retries=0, working_dir=None):
+    def exec(self, *command, check=False, quiet=False, always=False, retries=0, working_dir=None, env=None,
+             capture='tail', prefix=None):
         """
         Executes a shell command, or just logs it for dry runs
         Arguments:
@@ -141,15 +178,42 @@ class Shell(object):
             quiet: Do not produce any output
             always: If true, run for real in a dryrun
             working_dir: If set, the working directory to run the command in
+            env: If set, a dict of additional environment variables for this command only
+            capture: How much output to keep in the result: 'full', 'tail' (default, the last util.OUTPUT_TAIL_LINES lines) or 'none'.
+                     Use 'full' if the output will be parsed
+            prefix: If set, each line of output is printed as [prefix] line, to tell concurrent commands apart
         """
-        prev_dryrun = self.dryrun
-        if always:
-            self.dryrun = False
+        dryrun = self.dryrun and not always
+        return util.run_command(*command, check=check, quiet=quiet, dryrun=dryrun,
+                                retries=retries, working_dir=working_dir, env=self._exec_env(env),
+                                capture=capture, log_file=self.log_file, prefix=prefix)
 
-        result = util.run_command(*command, check=check, quiet=quiet, dryrun=self.dryrun,
-                                  retries=retries, working_dir=working_dir)
-        self.dryrun = prev_dryrun
-        return result
+    def exec_many(self, commands, check=False, quiet=False, always=False, working_dir=None, env=None,
+                  capture='tail'):
+        """
+        Executes several shell commands concurrently, or just logs them for dry runs.
+        Returns a list of ExecResults, one per command, in the order given.
+        Each entry in commands is either a command, or a dict with keys command, and optionally
+        working_dir, env and prefix, to override the arguments below for that command.
+        Output is interleaved by line, and each line is prefixed with the command it came from.
+        Arguments are as for exec
+        """
+        dryrun = self.dryrun and not always
+        entries = []
+        for entry in commands:
+            if isinstance(entry, dict) and 'env' in entry:
+                entry = dict(entry, env=self._exec_env(entry['env']))
+            entries.append(entry)
+        return util.run_commands(entries, check=check, quiet=quiet, dryrun=dryrun,
+                                 working_dir=working_dir, env=self._exec_env(env),
+                                 capture=capture, log_file=self.log_file)
+
+    def _exec_env(self, env):
+        """ Returns the full environment for a command: the current environment, plus env if given """
+        merged = self._environ()
+        if env:
+            merged = dict(merged, **{self._env_key(var): str(value) for var, value in env.items()})
+        return merged
 
     def get_secret(self, secret_id, key=None):
         """get string from secretsmanager"""
@@ -164,7 +228,7 @@ class Shell(object):
         # NOTE: log command args, but use "quiet" mode so that output isn't printed.
         # we don't want secrets leaked to the build log
         util.log_command(cmd)
-        result = self.exec(*cmd, check=True, quiet=True)
+        result = self.exec(*cmd, check=True, quiet=True, capture='full')
         secret_value = json.loads(result.output)
         if key is not None:
             screct_pairs = json.loads(secret_value['SecretString'])
@@ -1,18 +1,149 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
+import atexit
+import json
 import os
 import re
+import threading
 from builder.core.data import COMPILERS
 from builder.core.host import current_os, current_arch, normalize_target, normalize_arch
 from builder.core import util
 
 # helpful list of XCode clang output: https://gist.github.com/yamaya/2924292
 
+# Compilers found on PATH and their versions are remembered between runs, as discovering them
+# takes dozens of subprocesses and thousands of stat calls
+TOOLCHAIN_CACHE_FILE = os.path.expanduser(os.path.join('~', '.builder', 'toolchain-cache.json'))
+_TOOLCHAIN_CACHE_VERSION = 1
+_toolchain_cache = None
+_toolchain_cache_dirty = False
+_toolchain_cache_lock = threading.RLock()
+# the (PATH, PATHEXT) the cached tool locations were last checked against by this process
+_validated_path = None
+
+
+def _path_fingerprint():
+    """ PATH, and the mtime of each directory on it, which changes whenever an executable is added or removed """
+    dirs = []
+    for directory in util.getenv('PATH', '').split(os.pathsep):
+        try:
+            dirs.append([directory, os.stat(directory).st_mtime_ns])
+        except OSError:
+            dirs.append([directory, None])
+    return {'dirs': dirs, 'pathext': util.getenv('PATHEXT')}
+
+
+def _file_fingerprint(path):
+    """ Identifies the contents of the file at path, following symlinks. None if it doesn't exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def _load_toolchain_cache():
+    """ Returns the toolchain cache, reading it from disk on first use """
+    global _toolchain_cache
+    if _toolchain_cache is None:
+        try:
+            with open(TOOLCHAIN_CACHE_FILE, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+        if not isinstance(cache, dict) or cache.get('version') != _TOOLCHAIN_CACHE_VERSION:
+            cache = {'version': _TOOLCHAIN_CACHE_VERSION}
+        cache.setdefault('path', None)
+        cache.setdefault('tools', {})
+        cache.setdefault('compilers', {})
+        _toolchain_cache = cache
+        atexit.register(_save_toolchain_cache)
+    return _toolchain_cache
+
+
+def _save_toolchain_cache():
+    """ Writes the toolchain cache back to disk, if anything was discovered """
+    global _toolchain_cache_dirty
+    with _toolchain_cache_lock:
+        if not _toolchain_cache_dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(TOOLCHAIN_CACHE_FILE), exist_ok=True)
+            # write to the side and swap in, so that concurrent builders never see a partial file
+            tmp_file = '{}.{}.tmp'.format(TOOLCHAIN_CACHE_FILE, os.getpid())
+            with open(tmp_file, 'w') as cache_file:
+                json.dump(_toolchain_cache, cache_file)
+            os.replace(tmp_file, TOOLCHAIN_CACHE_FILE)
+            _toolchain_cache_dirty = False
+        except OSError as ex:
+            print('WARNING: Unable to write toolchain cache {}: {}'.format(TOOLCHAIN_CACHE_FILE, ex))
+
+
+def _validate_tool_cache():
+    """
+    Forgets every cached tool location if PATH, or the contents of any directory on it, has changed.
+    The directories are only checked once per value of PATH, call invalidate_tool_cache() after installing tools
+    """
+    global _toolchain_cache_dirty, _validated_path
+    path = (util.getenv('PATH', ''), util.getenv('PATHEXT'))
+    with _toolchain_cache_lock:
+        if path == _validated_path:
+            return
+        cache = _load_toolchain_cache()
+        fingerprint = _path_fingerprint()
+        if cache['path'] != fingerprint:
+            cache['path'] = fingerprint
+            cache['tools'] = {}
+            _toolchain_cache_dirty = True
+        _validated_path = path
+
+
+def invalidate_tool_cache():
+    """ Makes the next tool lookup check the directories on PATH for changes, call after installing executables """
+    global _validated_path
+    with _toolchain_cache_lock:
+        _validated_path = None
+
+
+def _where_tool(exe):
+    """ util.where(exe) without resolving symlinks, answered from the cache if possible """
+    global _toolchain_cache_dirty
+    with _toolchain_cache_lock:
+        tools = _load_toolchain_cache()['tools']
+        if exe in tools:
+            return tools[exe]
+    path = util.where(exe, resolve_symlinks=False)
+    with _toolchain_cache_lock:
+        tools[exe] = path
+        _toolchain_cache_dirty = True
+    return path
+
 
 def _compiler_version(cc):
+    """ Returns (compiler, major version) for the compiler at path cc, cached until the file changes """
+    global _toolchain_cache_dirty
+    if current_os() == 'windows' or not cc:
+        return _probe_compiler_version(cc)
+
+    fingerprint = _file_fingerprint(cc)
+    with _toolchain_cache_lock:
+        cached = _load_toolchain_cache()['compilers'].get(cc)
+        if fingerprint and cached and cached['file'] == fingerprint:
+            return cached['compiler'], cached['version']
+
+    compiler, version = _probe_compiler_version(cc)
+    if fingerprint:
+        with _toolchain_cache_lock:
+            _load_toolchain_cache()['compilers'][cc] = {
+                'file': fingerprint, 'compiler': compiler, 'version': version}
+            _toolchain_cache_dirty = True
+    return compiler, version
+
+
+def _probe_compiler_version(cc):
     if current_os() != 'windows':
-        result = util.run_command(cc, '--version', quiet=True)
+        result = util.run_command(cc, '--version', quiet=True, capture='full')
         lines = result.output.split('\n')
 
         for text in lines:
@@ -38,9 +169,10 @@ def _compiler_version(cc):
 def _find_compiler_tool(name, versions):
     # Filter out 'latest' from versions list. It will be handled separately.
     versions = [v for v in versions if v != 'latest']
+    _validate_tool_cache()
 
     # look for the default tool, and see if the version is in the search set
-    path = util.where(name, resolve_symlinks=False)
+    path = _where_tool(name)
     if path:
         version = _compiler_version(path)[1]
         if version in versions:
@@ -48,7 +180,7 @@ def _find_compiler_tool(name, versions):
     for version in versions:
         for pattern in ('{name}-{version}', '{name}-{version}.0'):
             exe = pattern.format(name=name, version=version)
-            path = util.where(exe, resolve_symlinks=False)
+            path = _where_tool(exe)
             if path:
                 return path, version
     return None, None
@@ -236,7 +368,7 @@ class Toolchain(object):
             # a single int you'll get told about anything >= version.
             # Perfect, exactly what we want.
             result = util.run_command('vswhere', '-legacy', '-version', version,
-                                      '-property', 'installationPath', '-sort', quiet=True)
+                                      '-property', 'installationPath', '-sort', quiet=True, capture='full')
             installations = result.output.splitlines()
             if installations:
                 return installations[0], version
@@ -321,7 +453,7 @@ class Toolchain(object):
                 version = Toolchain.find_msvc()[1]
             else:
                 # resolve CC and /usr/bin/cc
-                for env_cc in (util.where(os.environ.get('CC', None)), util.where('cc')):
+                for env_cc in (util.where(util.getenv('CC')), util.where('cc')):
                     if env_cc:
                         cc, ccver = _compiler_version(env_cc)
                         if cc and ccver:
@@ -2,16 +2,21 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 
+import asyncio
 import copy
-from collections import namedtuple, UserList
+from collections import deque, namedtuple, UserList
 from collections.abc import Iterable
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, reduce
 import os
+import re
 import stat
 from string import Formatter
 import subprocess
 import sys
-from time import sleep
+import threading
+from time import sleep, time_ns
 
 
 class VariableFormatter(Formatter):
@@ -26,18 +31,50 @@ class VariableFormatter(Formatter):
 
 _formatter = VariableFormatter()
 
+TEMPLATE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template(value):
+    """
+    Parses a format string once into (literal, variable name or None) segments.
+    Returns None if any field uses attributes, indexing, conversions or format specs, which need the full formatter
+    """
+    segments = []
+    for literal, field, format_spec, conversion in _formatter.parse(value):
+        if field is not None and (not field.isidentifier() or format_spec or conversion):
+            return None
+        segments.append((literal, field))
+    return tuple(segments)
+
+
+def _render_template(template, variables):
+    parts = []
+    for literal, name in template:
+        parts.append(literal)
+        if name is not None:
+            # missing variables are left in place, as VariableFormatter does
+            parts.append(format(variables.get(name, '{' + name + '}'), ''))
+    return ''.join(parts)
+
 
 def replace_variables(value, variables):
     """ Replaces all variables in all strings that can be found in the supplied value """
     key_type = type(value)
     if key_type == str:
+        # Nothing to replace or unescape
+        if '{' not in value and '}' not in value:
+            return value
 
         # If the whole string is a variable, just replace it
-        if value and value.rfind('{') == 0 and value.find('}') == len(value) - 1:
+        if value.rfind('{') == 0 and value.find('}') == len(value) - 1:
             return variables.get(value[1:-1], value)
 
-        # Strings just do a format
-        return _formatter.format(value, **variables)
+        # Strings are rendered from their compiled templates where possible, otherwise they just do a format
+        template = _compile_template(value)
+        if template is None:
+            return _formatter.format(value, **variables)
+        return _render_template(template, variables)
 
     elif key_type == list:
         # Update each element
@@ -54,6 +91,71 @@ def replace_variables(value, variables):
         return value
 
 
+def _variable_names(value):
+    """ The names of the variables referenced by a template string, e.g. {'a'} for 'x{a.b}y' """
+    template = _compile_template(value)
+    if template is not None:
+        return {name for _, name in template if name is not None}
+    names = set()
+    for _, field, _, _ in _formatter.parse(value):
+        if field:
+            names.add(re.split(r'[.\[]', field, maxsplit=1)[0])
+    return names
+
+
+class VariableIndex(object):
+    """
+    Records which strings in a tree of dicts and lists reference each variable, so that publishing a variable
+    only re-renders the strings that use it, rather than running replace_variables over the whole tree.
+    The index only sees changes made through it, so it must be rebuilt if the tree is otherwise modified
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        # variable name -> {(id(container), key): container}
+        self._refs = {}
+        # strings with escaped braces are re-rendered by every publish, as replace_variables would
+        self._always = {}
+        self._add(tree)
+
+    def _add(self, value, container=None, key=None):
+        value_type = type(value)
+        if value_type == str:
+            if container is None or '{' not in value and '}' not in value:
+                return
+            ref = (id(container), key)
+            names = _variable_names(value)
+            for name in names:
+                self._refs.setdefault(name, {})[ref] = container
+            if not names or '{{' in value or '}}' in value:
+                self._always[ref] = container
+        elif value_type == list:
+            for idx, item in enumerate(value):
+                self._add(item, value, idx)
+        elif value_type == dict:
+            for k, item in value.items():
+                self._add(item, value, k)
+
+    def publish(self, var, value):
+        """ Renders var into every string that references it """
+        variables = {var: value}
+        refs = self._refs.pop(var, {})
+        refs.update(self._always)
+        for (_, key), container in refs.items():
+            self._always.pop((id(container), key), None)
+            try:
+                current = container[key]
+            except (KeyError, IndexError):
+                continue
+            if type(current) != str:
+                continue
+            rendered = replace_variables(current, variables)
+            if rendered != current or type(rendered) != str:
+                container[key] = rendered
+            # the result may reference other variables, or be a whole new subtree
+            self._add(rendered, container, key)
+
+
 def list_unique(items):
     """ Given a list, return a new list with the unique items in order from the original list """
     uniq = set()
@@ -140,13 +242,81 @@ def to_list(val):
     return [val]
 
 
+# Shell layers its environment over os.environ rather than modifying it, and registers itself here, so that
+# in-process lookups (where(), commands run without an explicit env) see the same environment as its commands
+_environ_provider = None
+
+
+def set_environ_provider(provider):
+    """ provider() returns the environment in-process lookups should use. None restores os.environ """
+    global _environ_provider
+    _environ_provider = provider
+
+
+def environ():
+    """ The environment in-process lookups and commands run without an explicit env should use """
+    return _environ_provider() if _environ_provider else os.environ
+
+
+def getenv(var, default=None):
+    return environ().get(var, default)
+
+
+# names of the entries in each directory searched by where(), listed on first use
+_where_index = {}
+# the directories whose listings have been checked against their mtime since PATH last changed, or where()'s
+# cache was last invalidated. Until then, listings are trusted without touching the filesystem
+_where_checked = set()
+_where_path = None
+# a directory modified this recently may change again within the same mtime tick, so its listing is not kept
+_WHERE_RACY_NS = 2 * 10**9
+
+
+def invalidate_where_cache():
+    """
+    Makes where() check the directories it searches for changes, call after changing PATH or installing executables.
+    Listings of directories that haven't changed are kept
+    """
+    _where_checked.clear()
+
+
+def _list_dir(directory):
+    """ Lists directory, reusing the last listing if it has been checked, or its mtime is unchanged """
+    cached = _where_index.get(directory)
+    if cached is not None and directory in _where_checked:
+        return cached[1]
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        # missing directories are not remembered, they may be created later
+        _where_index.pop(directory, None)
+        return frozenset()
+    if cached is not None and cached[0] == mtime:
+        _where_checked.add(directory)
+        return cached[1]
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return frozenset()
+    if sys.platform == 'win32':
+        names = [name.lower() for name in names]
+    entries = frozenset(names)
+    if time_ns() - mtime >= _WHERE_RACY_NS:
+        _where_index[directory] = (mtime, entries)
+        _where_checked.add(directory)
+    else:
+        _where_index.pop(directory, None)
+    return entries
+
+
 def where(exe, path=None, resolve_symlinks=True):
     """ Platform agnostic `where executable` command """
+    global _where_path
 
     if exe is None:
         return None
     if path is None:
-        path = os.environ['PATH']
+        path = getenv('PATH', '')
     path_split = ':' if sys.platform != 'win32' else ';'
     paths = path.split(path_split)
     extlist = ['']
@@ -155,13 +325,24 @@ def where(exe, path=None, resolve_symlinks=True):
         return os.path.isfile(path) and os.access(path, os.X_OK)
 
     if sys.platform == 'win32':
-        pathext = os.environ['PATHEXT'].lower().split(os.pathsep)
+        pathext = getenv('PATHEXT', '').lower().split(os.pathsep)
         (base, ext) = os.path.splitext(exe)
         if ext.lower() not in pathext:
             extlist = pathext
+
+    # plain names are looked up in the index, rather than stat-ing a candidate in every directory
+    indexed = not any(sep and sep in exe for sep in (os.sep, os.altsep))
+    if indexed and path != _where_path:
+        # listings are checked once per value of PATH
+        invalidate_where_cache()
+        _where_path = path
     for ext in extlist:
         exe_name = exe + ext
+        index_name = exe_name.lower() if sys.platform == 'win32' else exe_name
         for p in paths:
+            # relative entries depend on the current directory, so are never indexed
+            if indexed and os.path.isabs(p) and index_name not in _list_dir(p):
+                continue
             exe_path = os.path.join(p, exe_name)
             if is_executable(exe_path):
                 # Remove any symlinks
@@ -174,8 +355,12 @@ def chmod_exec(file_path):
     os.chmod(file_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
 
-ExecResult = namedtuple('ExecResult', ['returncode', 'pid', 'output'])
+# error is set for commands run by run_commands that failed, see there
+ExecResult = namedtuple('ExecResult', ['returncode', 'pid', 'output', 'error'], defaults=[None])
 _retry_wait_secs = 3  # wait 3 seconds between retries of commands
+OUTPUT_TAIL_LINES = 1000  # lines of output kept in memory by default
+_READ_CHUNK_SIZE = 64 * 1024  # bytes of command output read at a time
+_output_lock = threading.Lock()  # serializes output lines from concurrent commands
 
 
 def _flatten_command(*command):
@@ -201,62 +386,141 @@ def command_to_str(*command):
     return subprocess.list2cmdline(cmds)
 
 
-def log_command(*command):
-    print('>', command_to_str(*command), flush=True)
+def log_command(*command, prefix=None):
+    if prefix:
+        print('[{}] >'.format(prefix), command_to_str(*command), flush=True)
+    else:
+        print('>', command_to_str(*command), flush=True)
+
+
+def _open_log(log_file):
+    if log_file:
+        return open(log_file, 'a', encoding='utf-8', errors='replace')
+    return nullcontext()
+
+
+async def _read_lines(stream):
+    """ Yields lines from stream, reading in chunks so that very long lines are not a problem """
+    pending = b''
+    while True:
+        chunk = await stream.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def _print_output(line, prefix=None):
+    """ Prints a line of command output, atomically so that concurrent commands interleave by line """
+    if prefix:
+        line = '[{}] {}'.format(prefix, line)
+    with _output_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+class _ThreadLoop(object):
+    """ An event loop for one thread, reused by every command the thread runs, and closed along with it """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+    def __del__(self):
+        self.loop.close()
+
 
+_thread_loops = threading.local()
 
-def run_command(*command, check=False, quiet=False, dryrun=False, retries=0, working_dir=None):
+
+def _run_async(coro):
+    """ Runs coro to completion, from any thread, whether or not the caller is itself running in an event loop """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        thread_loop = getattr(_thread_loops, 'current', None)
+        if thread_loop is None:
+            thread_loop = _thread_loops.current = _ThreadLoop()
+        return thread_loop.loop.run_until_complete(coro)
+
+    # this thread's loop is busy running the caller, so the command is run on a thread (and loop) of its own
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(_run_async, coro).result()
+
+
+async def _exec_async(command, quiet, working_dir, env, capture, log, prefix):
+    """ Runs a single command to completion, returning an ExecResult whatever its exit code """
+    proc = await asyncio.create_subprocess_shell(
+        command_to_str(*command),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=working_dir,
+        env=env)
+
+    # Convert all output to strings, which makes it much easier to both print
+    # and process, since all known uses of parsing output want strings anyway
+    lines = None
+    if capture == 'full':
+        lines = []
+    elif capture == 'tail':
+        lines = deque(maxlen=OUTPUT_TAIL_LINES)
+    async for line in _read_lines(proc.stdout):
+        # ignore weird characters coming back from the shell (colors, etc)
+        line = line.decode('ascii', 'ignore')
+        # We're reading in binary mode, so no automatic newline translation
+        if sys.platform == 'win32':
+            line = line.replace('\r\n', '\n')
+        if lines is not None:
+            lines.append(line)
+        if log:
+            log.write(line)
+        if not quiet:
+            _print_output(line, prefix)
+    await proc.wait()
+    output = ''.join(lines) if lines is not None else ''
+    return ExecResult(proc.returncode, proc.pid, output)
+
+
+def run_command(*command, check=False, quiet=False, dryrun=False, retries=0, working_dir=None, env=None,
+                capture='tail', log_file=None, prefix=None):
+    """
+    Runs a command, streaming its output to stdout (unless quiet) and appending it to log_file, if given.
+    Quiet commands are never written to log_file, as they may produce secrets.
+    capture controls how much output is kept in memory and returned in ExecResult.output:
+        'full': all of it, for callers that parse the output
+        'tail': only the last OUTPUT_TAIL_LINES lines
+        'none': nothing
+    If prefix is given, each line of output is printed as [prefix] line, to tell concurrent commands apart.
+    """
     if not quiet:
-        log_command(*command)
+        log_command(*command, prefix=prefix)
     if dryrun:
         return None
     tries = retries + 1
     if not working_dir:
         working_dir = os.getcwd()
+    if env is None:
+        env = environ()
+    if quiet:
+        log_file = None
 
     output = None
     while tries > 0:
         tries -= 1
         try:
-            cmd = command_to_str(*command)
-
-            # force the working directory
-            cwd = os.getcwd()
-            os.chdir(working_dir)
-
-            proc = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=True,
-                bufsize=0)  # do not buffer output
-            with proc:
-
-                # Convert all output to strings, which makes it much easier to both print
-                # and process, since all known uses of parsing output want strings anyway
-                output = ""
-                line = proc.stdout.readline()
-                while (line):
-                    # ignore weird characters coming back from the shell (colors, etc)
-                    if not isinstance(line, str):
-                        line = line.decode('ascii', 'ignore')
-                    # We're reading in binary mode, so no automatic newline translation
-                    if sys.platform == 'win32':
-                        line = line.replace('\r\n', '\n')
-                    output += line
-                    if not quiet:
-                        print(line, end='', flush=True)
-                    line = proc.stdout.readline()
-                proc.wait()
-
-                # restore working directory before exiting the function
-                os.chdir(cwd)
-
-                if proc.returncode != 0:
-                    raise Exception(
-                        f'Command exited with code {proc.returncode}')
-
-                return ExecResult(proc.returncode, proc.pid, output)
+            # the working directory is passed to the child rather than chdir-ing, and each thread
+            # has its own event loop, so that commands can safely be run from multiple threads
+            with _open_log(log_file) as log:
+                result = _run_async(_exec_async(command, quiet, working_dir, env, capture, log, prefix))
+
+            if result.returncode != 0:
+                raise Exception(
+                    f'Command exited with code {result.returncode}')
+
+            return result
 
         except Exception as ex:
             print('Failed to run {}: {}'.format(
@@ -271,15 +535,106 @@ def run_command(*command, check=False, quiet=False, dryrun=False, retries=0, wor
     return ExecResult(-1, -1, output)
 
 
+def run_commands(commands, check=False, quiet=False, dryrun=False, working_dir=None, env=None,
+                 capture='tail', log_file=None):
+    """
+    Runs several commands concurrently, returning an ExecResult for each, in the order given.
+    Each entry in commands is either a command, or a dict with keys:
+        command: the command to run
+        working_dir: (optional) the working directory for this command, defaults to working_dir
+        env: (optional) the environment for this command, defaults to env
+        prefix: (optional) the prefix for each line of this command's output, defaults to its index
+    Output is interleaved by line, each line prefixed with the command it came from.
+    Commands that exit with an error keep their returncode and output, and have an exception describing the
+    failure as error. Commands that could not be run at all have a returncode of -1, and their exception as error.
+    If check is true, an exception is raised after all commands finish if any of them failed.
+    """
+    specs = []
+    for idx, entry in enumerate(commands):
+        if not isinstance(entry, dict):
+            entry = {'command': entry}
+        specs.append({
+            'command': entry['command'],
+            'working_dir': entry.get('working_dir', working_dir) or os.getcwd(),
+            'env': entry.get('env', env) or environ(),
+            'prefix': entry.get('prefix', str(idx)),
+        })
+
+    if not quiet:
+        for spec in specs:
+            log_command(spec['command'], prefix=spec['prefix'])
+    if dryrun:
+        return [None] * len(specs)
+    if quiet:
+        log_file = None
+
+    async def _exec_all(log):
+        return await asyncio.gather(
+            *[_exec_async([spec['command']], quiet, spec['working_dir'], spec['env'], capture, log, spec['prefix'])
+              for spec in specs],
+            return_exceptions=True)
+
+    with _open_log(log_file) as log:
+        results = _run_async(_exec_all(log))
+
+    failed = 0
+    for idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            results[idx] = ExecResult(-1, -1, None, result)
+        elif result.returncode != 0:
+            results[idx] = result._replace(error=Exception(f'Command exited with code {result.returncode}'))
+        else:
+            continue
+        failed += 1
+        print('Failed to run {}: {}'.format(
+            ' '.join(_flatten_command(specs[idx]['command'])), results[idx].error))
+    if check and failed:
+        raise Exception('{} of {} commands failed'.format(failed, len(specs)))
+    return results
+
+
+# id -> (object, hash) for trees that are never modified, see cache_content_hashes
+_content_hashes = {}
+
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def cache_content_hashes(*trees):
+    """
+    Computes the content hash of every dict and list in trees once, and reuses it from then on.
+    Only for data that is never modified, such as the host/target/compiler tables
+    """
+    def _cache(o):
+        if isinstance(o, dict):
+            for v in o.values():
+                _cache(v)
+        elif isinstance(o, list):
+            for v in o:
+                _cache(v)
+        else:
+            return
+        # children are cached first, so this only combines their hashes
+        _content_hashes[id(o)] = (o, content_hash(o))
+
+    for tree in trees:
+        _cache(tree)
+
+
 def content_hash(o):
     """
     Makes a hash from a dictionary, list, tuple or set to any level, that contains
     only other hashable types (including any lists, tuples, sets, and
     dictionaries).
     """
+    if type(o) in _SCALAR_TYPES:
+        return hash(o)
+
+    cached = _content_hashes.get(id(o))
+    if cached is not None and cached[0] is o:
+        return cached[1]
 
     if isinstance(o, (set, tuple, list)):
-        return tuple([content_hash(item) for item in o])
+        return hash(tuple([content_hash(item) for item in o]))
     elif not isinstance(o, dict):
         if isinstance(o, object) and hasattr(o, '__dict__'):
             return content_hash(o.__dict__)
@@ -288,33 +643,38 @@ def content_hash(o):
         except:
             return hash(str(o))
 
-    hashes = {}
-    for k, v in o.items():
-        hashes[k] = content_hash(v)
-
-    return hash(tuple(frozenset(sorted(hashes.items()))))
+    # item order doesn't matter, so there's no need to sort
+    return hash(frozenset([(k, content_hash(v)) for k, v in o.items()]))
 
 
 class UniqueList(UserList):
-    """ A list that only allows unique items to be appended. Items are id'ed by hash via content_hash """
+    """
+    A list that only allows unique items to be appended. Items are id'ed by hash via content_hash,
+    though an object that is already in the list is recognized by identity without hashing it again
+    """
 
     def __init__(self, items=None):
         super().__init__()
         if items is None:
             items = []
         self._hashes = set()
+        # id -> item, holding the item so that its id can't be reused while it's here
+        self._ids = {}
         for item in items:
             self.append(item)
 
     def __delitem__(self, idx):
-        hash = content_hash(self.data[idx])
-        self._hashes.remove(hash)
+        value = self.data[idx]
+        self._hashes.discard(content_hash(value))
+        self._ids.pop(id(value), None)
         self.data.__delitem__(idx)
 
     def __setitem__(self, idx, value):
         hash = content_hash(value)
         if hash not in self._hashes:
             self._hashes.add(hash)
+            self._ids.pop(id(self.data[idx]), None)
+            self._ids[id(value)] = value
             self.data.__setitem__(idx, value)
 
     # This allows for a += [b] style appending
@@ -324,9 +684,12 @@ class UniqueList(UserList):
         return self
 
     def append(self, value):
+        if self._ids.get(id(value)) is value:
+            return
         hash = content_hash(value)
         if hash not in self._hashes:
             self._hashes.add(hash)
+            self._ids[id(value)] = value
             self.data.append(value)
 
 
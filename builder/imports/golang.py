@@ -4,7 +4,7 @@
 import os
 from pathlib import Path
 
-from builder.core.fetch import fetch_and_extract, mirror_package
+from builder.core.fetch import fetch_and_extract
 from builder.core.project import Import
 import builder.core.util as util
 from builder.core.host import current_platform
@@ -47,7 +47,7 @@ class GOLANG(Import):
         # If this is a local build, check the local machine
         if not cross_compile or target not in URLs:
             # run `go version`
-            result = util.run_command('go', 'version')
+            result = sh.exec('go', 'version', always=True, capture='full')
             if result.returncode == 0:
                 # check the version, we need version >=1.18
                 version_str = result.output.split(" ")[2][2:]
@@ -75,7 +75,8 @@ class GOLANG(Import):
         ext = '.tar.gz' if url.endswith('.tar.gz') else '.zip'
         filename = '{}/golang{}'.format(install_dir, ext)
         print('Downloading {}'.format(url))
-        fetch_and_extract(url, filename, install_dir)
+        # cross compiles mount the deps dir into a container, where symlinks out of it won't resolve
+        fetch_and_extract(url, filename, install_dir, cache=True, link=not cross_compile)
         os.remove(filename)
 
         # Set PATH
@@ -90,6 +91,9 @@ class GOLANG(Import):
 
         self.installed = True
 
-    def mirror(self, env):
-        for src_url in URLs.values():
-            mirror_package(self.name, src_url)
+    def package_urls(self, spec=None):
+        if spec:
+            # go only generates code at build time, so even cross compiles use the one for the current platform
+            url = URLs.get(current_platform())
+            return [url] if url else []
+        return list(URLs.values())
@@ -7,7 +7,7 @@ from pathlib import Path
 import tarfile
 import zipfile
 
-from builder.core.fetch import fetch_and_extract, mirror_package
+from builder.core.fetch import fetch_and_extract
 from builder.core.project import Import
 import builder.core.util as util
 
@@ -46,10 +46,10 @@ class JDK8(Import):
 
         # If this is a local build, check the local machine
         if not cross_compile or target not in URLs:
-            javac_path = util.where('javac')
+            javac_path = sh.where('javac')
             if javac_path:
                 javac_path = javac_path.replace('/bin/javac', '')
-            prefixes = [javac_path, os.environ.get('JAVA_HOME', None)]
+            prefixes = [javac_path, sh.getenv('JAVA_HOME')]
             required_files = [
                 ['include/jni.h'],
                 ['lib/**/libjvm.so', '**/lib/**/libjvm.so',
@@ -93,7 +93,8 @@ class JDK8(Import):
         ext = '.tar.gz' if url.endswith('.tar.gz') else '.zip'
         filename = '{}/jdk8{}'.format(install_dir, ext)
         print('Downloading {}'.format(url))
-        fetch_and_extract(url, filename, install_dir)
+        # cross compiles mount the deps dir into a container, where symlinks out of it won't resolve
+        fetch_and_extract(url, filename, install_dir, cache=True, link=not cross_compile)
         os.remove(filename)
 
         jdk_home = glob.glob(os.path.join(install_dir, '*jdk*'))[0]
@@ -112,6 +113,8 @@ class JDK8(Import):
         env.variables['java_home'] = self.path
         self.installed = True
 
-    def mirror(self, env):
-        for src_url in URLs.values():
-            mirror_package(self.name, src_url)
+    def package_urls(self, spec=None):
+        if spec:
+            url = URLs.get('{}-{}'.format(spec.target, spec.arch))
+            return [url] if url else []
+        return list(URLs.values())
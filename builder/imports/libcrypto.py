@@ -30,6 +30,21 @@ class LibCrypto(Import):
     def resolved(self):
         return True
 
+    def _package_url(self, spec):
+        lib_version = '1.1.1'
+        lib_os = spec.target
+        if current_host() == 'manylinux' and spec.arch != 'armv8':
+            lib_os = 'manylinux'
+            lib_version = '1.0.2'
+        return self.url.format(version=lib_version,
+                               os=lib_os, arch=spec.arch)
+
+    def package_urls(self, spec=None):
+        # these are built and hosted by us, so there is nothing to mirror
+        if not spec or current_host() == 'al2012':
+            return []
+        return [self._package_url(spec)]
+
     def install(self, env):
         if self.installed:
             return
@@ -63,13 +78,7 @@ class LibCrypto(Import):
         print('Installing pre-built libcrypto binaries for {}-{} to {}'.format(
             env.spec.target, env.spec.arch, install_dir))
 
-        lib_version = '1.1.1'
-        lib_os = env.spec.target
-        if current_host() == 'manylinux' and env.spec.arch != 'armv8':
-            lib_os = 'manylinux'
-            lib_version = '1.0.2'
-        url = self.url.format(version=lib_version,
-                              os=lib_os, arch=env.spec.arch)
+        url = self._package_url(env.spec)
         filename = '{}/libcrypto.tar.gz'.format(install_dir)
         print('Downloading {}'.format(url))
         fetch_and_extract(url, filename, install_dir)
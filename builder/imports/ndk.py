@@ -7,7 +7,7 @@ from pathlib import Path
 from urllib.parse import urlparse
 import zipfile
 
-from builder.core.fetch import fetch_and_extract, mirror_package
+from builder.core.fetch import fetch_and_extract
 from builder.core.project import Import
 from builder.core.util import chmod_exec
 
@@ -52,8 +52,9 @@ class NDK(Import):
 
         sh.mkdir(install_dir)
         filename = '{}/ndk-r{}.zip'.format(install_dir, ANDROID_NDK_VERSION)
-        # Extract to deps dir, because zip file contains android-ndk-r{version} directory
-        fetch_and_extract(self.url, filename, env.deps_dir)
+        # Extract to deps dir, because zip file contains android-ndk-r{version} directory.
+        # The NDK is used from within the cross compile container, so must not be symlinked out of the deps dir
+        fetch_and_extract(self.url, filename, env.deps_dir, cache=True, link=False)
         binaries = glob.glob(
             os.path.join(self.prefix, 'toolchains/llvm/prebuilt/linux-x86_64/bin/*'))
         for binary in binaries:
@@ -61,5 +62,5 @@ class NDK(Import):
 
         self.installed = True
 
-    def mirror(self, env):
-        mirror_package(self.name, self.url)
+    def package_urls(self, spec=None):
+        return [self.url]
@@ -5,7 +5,6 @@
 from builder.core.fetch import fetch_script, fetch_and_extract
 from builder.core.host import current_os, current_arch
 from builder.core.project import Import
-import builder.core.util as util
 from builder.actions.install import InstallPackages
 from builder.actions.script import Script
 
@@ -39,10 +38,9 @@ class NodeJS(Import):
         self.installed = False
 
     def install(self, env):
-        if self.installed or (util.where('node') and current_os() == 'windows'):
-            return
-
         sh = env.shell
+        if self.installed or (sh.where('node') and current_os() == 'windows'):
+            return
 
         self.install_dir = os.path.join(env.deps_dir, self.name)
         sh.mkdir(self.install_dir)
@@ -59,6 +57,16 @@ class NodeJS(Import):
 
         self.installed = True
 
+    def package_urls(self, spec=None):
+        # third party downloads, so they are prefetched but never mirrored
+        if not spec:
+            return []
+        # the nvm installer, and the unofficial build used on x86, where nvm has no node to install
+        urls = [self.url]
+        if spec.arch == 'x86':
+            urls.append(_unofficial_build_url(_normalize_version(self.version), spec.target, 'x86'))
+        return urls
+
     def install_node_via_nvm(self, env):
         sh = env.shell
         # Install node
@@ -66,7 +74,7 @@ class NodeJS(Import):
 
         # Fetch path to installed node, add to PATH
         if current_os() != 'windows':
-            result = sh.exec(self.nvm, 'which', self.version, check=True)
+            result = sh.exec(self.nvm, 'which', self.version, check=True, capture='full')
             node_path = os.path.dirname(result.output)
             sh.setenv('PATH', '{}{}{}'.format(
                 node_path, os.pathsep, sh.getenv('PATH')))
@@ -88,7 +96,7 @@ class NodeJS(Import):
                 ]
             )
             script.flush()
-        result = sh.exec(env_script, check=True, quiet=True)
+        result = sh.exec(env_script, check=True, quiet=True, capture='full')
         lines = result.output.split('\n')
         vars = {}
         for line in lines:
@@ -123,21 +131,8 @@ class NodeJS(Import):
         sh = env.shell
         print('Installing node build directly'.format(self.version))
 
-        # Normaliz version format, please note 12.16.3 is the last version has x86 support
-        def normalize_version(v):
-            append_times = 0
-            while re.match(r'^([0-9]+\.){2}[0-9]+$', v) == None:
-                # Only try append sub version twice
-                if append_times < 2:
-                    v += ".0"
-                    append_times += 1
-                else:  # DEFAULT TO 12.0.0
-                    return (DEFAULT_VERSION + ".0.0")
-            return v
-
-        version = normalize_version(self.version)
-        url = "https://unofficial-builds.nodejs.org/download/release/v{}/node-v{}-{}-{}.tar.gz".format(
-            version, version, current_os(), current_arch())
+        version = _normalize_version(self.version)
+        url = _unofficial_build_url(version, current_os(), current_arch())
         package_name = "node-v{}-{}-{}".format(version, current_os(), current_arch())
 
         # Fetch the node build
@@ -150,6 +145,24 @@ class NodeJS(Import):
         sh.setenv('PATH', '{}{}{}'.format(node_path, os.pathsep, sh.getenv('PATH')))
 
 
+# Normaliz version format, please note 12.16.3 is the last version has x86 support
+def _normalize_version(v):
+    append_times = 0
+    while re.match(r'^([0-9]+\.){2}[0-9]+$', v) == None:
+        # Only try append sub version twice
+        if append_times < 2:
+            v += ".0"
+            append_times += 1
+        else:  # DEFAULT TO 12.0.0
+            return (DEFAULT_VERSION + ".0.0")
+    return v
+
+
+def _unofficial_build_url(version, os_name, arch):
+    return "https://unofficial-builds.nodejs.org/download/release/v{}/node-v{}-{}-{}.tar.gz".format(
+        version, version, os_name, arch)
+
+
 class Node12(NodeJS):
     def __init__(self, **kwargs):
         super().__init__(version='12', **kwargs)
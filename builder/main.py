@@ -11,8 +11,11 @@ from builder.actions.script import Script
 from builder.actions.install import InstallPackages, InstallCompiler
 from builder.actions.git import DownloadDependencies
 from builder.actions.mirror import Mirror
+from builder.actions.prefetch import Prefetch
+from builder.actions.cache import Cache
 from builder.actions.release import ReleaseNotes
 from builder.core.env import Env
+from builder.core.fetch import set_offline
 from builder.core.project import Project
 from builder.core.scripts import Scripts
 from builder.core.toolchain import Toolchain
@@ -128,6 +131,10 @@ def coerce_arg(arg):
     return arg
 
 
+# commands which can run without a project
+PROJECTLESS_COMMANDS = ('mirror', 'cache')
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--dry-run', action='store_true',
@@ -149,6 +156,20 @@ def parse_args():
                         choices=data.PLATFORMS.keys())
     parser.add_argument('--variant', type=str, help="Build variant to use instead of default")
     parser.add_argument('--cmake-extra', action='append', default=[])
+    parser.add_argument('--build-jobs', type=int, default=1,
+                        help="Number of independent upstream dependencies to build concurrently")
+    parser.add_argument('--fetch-jobs', type=int, default=1,
+                        help="Number of dependency repositories to clone concurrently")
+    parser.add_argument('--git-cache', action='store_true',
+                        help="Keep bare mirrors of dependency repositories in ~/.builder/git-cache and clone from them")
+    parser.add_argument('--build-cache', action='store_true',
+                        help="Restore upstream dependencies from ~/.builder/install-cache instead of rebuilding them")
+    parser.add_argument('--log-file', type=str,
+                        help="Append the output of every command run to this file")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Keep the build directory between runs, only re-running cmake configure when its inputs change")
+    parser.add_argument('--offline', action='store_true',
+                        help="Use only the local package manifest and cache, never download packages or the remote manifest")
     parser.add_argument('--coverage', action='store_true',
                         help="Enable test coverage report and upload it the codecov. Only supported when using cmake with gcc as compiler, error out on other cases.\n"
                         + "Use --coverage-include and --coverage-exclude to report the needed coverage file. The default code coverage report will include everything in the `source/` directory")
@@ -166,7 +187,8 @@ def parse_args():
     # eat command and optionally spec
     if argv and not argv[0].startswith('-'):
         command = argv.pop(0)
-        if len(argv) >= 1 and not argv[0].startswith('-'):
+        # commands that don't need a project take an operation rather than a spec, which is left for the action
+        if command not in PROJECTLESS_COMMANDS and len(argv) >= 1 and not argv[0].startswith('-'):
             spec = argv.pop(0)
 
     if not command:
@@ -264,6 +286,7 @@ def upload_test_coverage(env):
 
 def main():
     args, spec = parse_args()
+    set_offline(args.offline)
 
     if args.build_dir != '.':
         if not os.path.isdir(args.build_dir):
@@ -289,9 +312,13 @@ def main():
 
     Scripts.load()
 
-    if not env.project and args.command != 'mirror':
-        print('No project specified and no project found in current directory')
-        sys.exit(1)
+    if not env.project:
+        if args.command not in PROJECTLESS_COMMANDS:
+            print('No project specified and no project found in current directory')
+            sys.exit(1)
+        # there's no project config to build a toolchain from, and nothing to set up
+        Scripts.run_action(args.command, env)
+        return
 
     if env.config.get('needs_compiler', True):
         # Resolve the actual compiler from the system toolchain and update the spec.
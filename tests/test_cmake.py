@@ -0,0 +1,159 @@
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from builder.actions import cmake
+
+
+class TestInstallCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(cmake, 'INSTALL_CACHE_DIR', os.path.join(self.tmp.name, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _install(self, install_dir, build_dir):
+        """fake a cmake install of a library and its soname symlink"""
+        lib_dir = os.path.join(install_dir, 'lib')
+        os.makedirs(lib_dir)
+        os.makedirs(build_dir)
+        lib = os.path.join(lib_dir, 'libfoo.so.1')
+        with open(lib, 'w') as f:
+            f.write('foo')
+        link = os.path.join(lib_dir, 'libfoo.so')
+        os.symlink('libfoo.so.1', link)
+        with open(os.path.join(build_dir, 'install_manifest.txt'), 'w') as f:
+            f.write('{}\n{}'.format(lib, link))
+
+    def test_save_and_restore(self):
+        """installed files should round trip through the cache, preserving symlinks"""
+        install_dir = os.path.join(self.tmp.name, 'install')
+        self._install(install_dir, os.path.join(self.tmp.name, 'build'))
+        cmake._save_install_cache('key', os.path.join(self.tmp.name, 'build'), install_dir)
+
+        restore_dir = os.path.join(self.tmp.name, 'restore')
+        self.assertTrue(cmake._restore_install_cache('key', restore_dir))
+        self.assertTrue(os.path.islink(os.path.join(restore_dir, 'lib', 'libfoo.so')))
+        with open(os.path.join(restore_dir, 'lib', 'libfoo.so')) as f:
+            self.assertEqual('foo', f.read())
+
+    def test_miss(self):
+        """unknown keys should not restore anything"""
+        restore_dir = os.path.join(self.tmp.name, 'restore')
+        self.assertFalse(cmake._restore_install_cache('missing', restore_dir))
+        self.assertFalse(os.path.exists(restore_dir))
+
+    def test_key_requires_cacheable_dependencies(self):
+        """a dependency that could not be cached makes its consumers uncacheable"""
+        self.assertIsNone(cmake._install_cache_key(mock.Mock(), mock.Mock(), [], ['abc', None]))
+
+    def test_key_uses_build_config(self):
+        """keys should cover the config that changes what is installed, and nothing else"""
+        env = mock.Mock()
+        env.toolchain.name = 'gcc-11'
+        project = mock.Mock()
+        config = {'cmake_args': ['-DFOO=1'], 'build_env': {'CFLAGS': '-O2'}, 'variants': object()}
+        project.get_config.return_value = config
+
+        with mock.patch.object(cmake, '_source_revision', return_value='abc123'):
+            key = cmake._install_cache_key(env, project, ['-DBAR=1'], ['def'])
+            self.assertIsNotNone(key)
+
+            config['test_steps'] = ['echo tested']
+            self.assertEqual(key, cmake._install_cache_key(env, project, ['-DBAR=1'], ['def']))
+            config['build_env'] = {'CFLAGS': '-O3'}
+            self.assertNotEqual(key, cmake._install_cache_key(env, project, ['-DBAR=1'], ['def']))
+
+            # values that can't be hashed reproducibly are an error, not a guess
+            config['env'] = {'PATH': object()}
+            with self.assertRaises(TypeError):
+                cmake._install_cache_key(env, project, ['-DBAR=1'], ['def'])
+
+
+def _git(*args, cwd=None):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args], cwd=cwd, text=True).strip()
+
+
+class TestConfigureStamp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.dict(cmake._install_cache_keys, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.source_dir = os.path.join(self.tmp.name, 'lib')
+        _git('init', '--quiet', self.source_dir)
+        self._commit('one')
+
+        self.project = mock.Mock(name='MockProject', path=self.source_dir)
+        self.project.name = 'lib'
+        self.project.get_config.return_value = {}
+        self.project.cmake_args.return_value = []
+        self.env = mock.Mock(name='MockEnv', root_dir=self.tmp.name, build_dir=os.path.join(self.tmp.name, 'build'),
+                             install_dir=os.path.join(self.tmp.name, 'install'), variables={})
+        self.env.args = mock.Mock(incremental=True, config='RelWithDebInfo', build_cache=False)
+        self.env.shell.dryrun = False
+        self.env.toolchain = mock.Mock(name='MockToolchain', cross_compile=False, host='linux', compiler='default',
+                                       shell_env=[])
+        self.env.toolchain.name = 'default'
+        self.env.toolchain.cmake_binary.return_value = 'cmake'
+        self.build_dir = os.path.join(self.env.build_dir, 'lib')
+
+    def _commit(self, name):
+        with open(os.path.join(self.source_dir, name), 'w') as f:
+            f.write(name)
+        _git('add', name, cwd=self.source_dir)
+        _git('commit', '--quiet', '-m', name, cwd=self.source_dir)
+
+    def _configures(self, cmake_extra=()):
+        """runs an incremental configure and build, returning whether cmake was asked to configure"""
+        self.env.shell.reset_mock()
+        cmake._install_cache_keys.clear()
+        cmake._configure_and_build(self.env, self.project, list(cmake_extra))
+        configured = any('--build' not in call.args for call in self.env.shell.exec.call_args_list)
+        # cmake would have written its cache
+        with open(os.path.join(self.build_dir, 'CMakeCache.txt'), 'w'):
+            pass
+        return configured
+
+    def test_stamps(self):
+        """stamps should round trip, and change with the args, toolchain and source revision"""
+        stamp = cmake._configure_stamp(self.env, self.project, ['-DFOO=ON'])
+        self.assertEqual(stamp, cmake._configure_stamp(self.env, self.project, ['-DFOO=ON']))
+        self.assertNotEqual(stamp, cmake._configure_stamp(self.env, self.project, ['-DFOO=OFF']))
+        self.env.toolchain.name = 'clang'
+        self.assertNotEqual(stamp, cmake._configure_stamp(self.env, self.project, ['-DFOO=ON']))
+        self.env.toolchain.name = 'default'
+        self._commit('two')
+        self.assertNotEqual(stamp, cmake._configure_stamp(self.env, self.project, ['-DFOO=ON']))
+
+        self.assertIsNone(cmake._read_stamp(self.tmp.name))
+        cmake._write_stamp(self.tmp.name, stamp)
+        self.assertEqual(stamp, cmake._read_stamp(self.tmp.name))
+        cmake._write_stamp(self.tmp.name, None)
+        self.assertIsNone(cmake._read_stamp(self.tmp.name))
+
+    def test_incremental_configure(self):
+        """incremental builds should only re-configure when the args or source revision change"""
+        os.makedirs(self.build_dir)
+        self.env.shell.mkdir.side_effect = lambda path: os.makedirs(path, exist_ok=True)
+        self.assertTrue(self._configures())
+        self.assertFalse(self._configures())
+
+        self.assertTrue(self._configures(['-DFOO=ON']))
+        self.assertFalse(self._configures(['-DFOO=ON']))
+
+        self._commit('two')
+        self.assertTrue(self._configures(['-DFOO=ON']))
+        self.assertFalse(self._configures(['-DFOO=ON']))
+
+        # a build dir cmake never finished configuring is configured again
+        os.remove(os.path.join(self.build_dir, 'CMakeCache.txt'))
+        self.assertTrue(self._configures(['-DFOO=ON']))
@@ -0,0 +1,458 @@
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+
+from builder.core import fetch
+
+
+class _ManifestHandler(BaseHTTPRequestHandler):
+    """ Serves server.manifest, honoring If-None-Match """
+    etag = '"v1"'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.manifest).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.cache_dir = os.path.join(self.tmp.name, 'pkg-cache')
+        os.mkdir(self.cache_dir)
+        self.manifest = fetch.Manifest.__new__(fetch.Manifest)
+        self.manifest.remote = {}
+        self.manifest.local = {}
+        self.extract_cache_dir = os.path.join(self.tmp.name, 'extract-cache')
+        for patcher in (
+                mock.patch.object(fetch, 'CACHE_DIR', self.cache_dir),
+                mock.patch.object(fetch, 'EXTRACT_CACHE_DIR', self.extract_cache_dir),
+                mock.patch.object(fetch, '_manifest', self.manifest),
+                mock.patch.object(fetch, '_trees_in_use', set())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.contents = os.urandom(3 * fetch.DOWNLOAD_CHUNK_SIZE + 17)
+        self.digest = sha256(self.contents).hexdigest()
+        self.source = os.path.join(self.tmp.name, 'source', 'package.tar.gz')
+        os.mkdir(os.path.dirname(self.source))
+        with open(self.source, 'wb') as f:
+            f.write(self.contents)
+        self.url = 'file://' + self.source
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_fetch_caches_download(self):
+        """a verified download should be added to the cache, and used from there next time"""
+        self.manifest.remote['package.tar.gz'] = self.digest
+        local_path = os.path.join(self.tmp.name, 'out', 'package.tar.gz')
+        fetch.fetch(self.url, local_path)
+
+        self.assertEqual(self.contents, self._read(local_path))
+        self.assertEqual(self.contents, self._read(os.path.join(self.cache_dir, self.digest)))
+        self.assertEqual(self.digest, self.manifest.local['package.tar.gz'])
+        self.assertEqual([self.digest], os.listdir(self.cache_dir))
+
+        os.remove(self.source)
+        again = os.path.join(self.tmp.name, 'again', 'package.tar.gz')
+        fetch.fetch(self.url, again)
+        self.assertEqual(self.contents, self._read(again))
+
+        # entries are read-only, and are linked rather than copied, both into the cache and out of it,
+        # so the download shares the entry's permissions
+        cache_path = os.path.join(self.cache_dir, self.digest)
+        self.assertFalse(os.stat(cache_path).st_mode & 0o222)
+        for path in (local_path, again):
+            self.assertTrue(os.path.samefile(path, cache_path))
+
+        # scripts are changed in place, so get their own copies
+        script_path = os.path.join(self.tmp.name, 'script', 'package.tar.gz')
+        fetch.fetch_script(self.url, script_path)
+        self.assertFalse(os.path.samefile(script_path, cache_path))
+        self.assertTrue(os.stat(script_path).st_mode & 0o111)
+        with open(script_path, 'ab') as f:
+            f.write(b'modified')
+        self.assertEqual(self.contents, self._read(cache_path))
+        self.assertFalse(os.stat(cache_path).st_mode & 0o111)
+
+    def test_fetch_survives_eviction(self):
+        """a package evicted by another process between being found in the cache and linked should be downloaded"""
+        self.manifest.remote['package.tar.gz'] = self.digest
+        fetch.fetch(self.url, os.path.join(self.tmp.name, 'first', 'package.tar.gz'))
+        cache_path = os.path.join(self.cache_dir, self.digest)
+
+        link = os.link
+
+        def _evicted(src, dst):
+            if src == cache_path and os.path.exists(cache_path):
+                fetch.remove_cache_entry(cache_path)
+            link(src, dst)
+
+        local_path = os.path.join(self.tmp.name, 'again', 'package.tar.gz')
+        with mock.patch.object(fetch.os, 'link', side_effect=_evicted):
+            self.assertEqual(self.digest, fetch.fetch(self.url, local_path))
+        self.assertEqual(self.contents, self._read(local_path))
+        self.assertTrue(os.path.isfile(cache_path))
+        self.assertEqual([os.path.basename(local_path)], os.listdir(os.path.dirname(local_path)))
+
+    def test_reflink_or_copy(self):
+        """files should be copied whether or not the filesystem supports reflinks"""
+        dest = os.path.join(self.tmp.name, 'copy')
+        fetch._reflink_or_copy(self.source, dest)
+        self.assertEqual(self.contents, self._read(dest))
+        self.assertFalse(os.path.samefile(self.source, dest))
+
+    def test_fetch_rejects_mismatched_digest(self):
+        """a download that doesn't match the manifest should not be used or cached"""
+        self.manifest.remote['package.tar.gz'] = sha256(b'something else').hexdigest()
+        local_path = os.path.join(self.tmp.name, 'package.tar.gz')
+        with self.assertRaises(Exception):
+            fetch.fetch(self.url, local_path)
+
+        self.assertEqual([], os.listdir(self.cache_dir))
+        self.assertFalse(os.path.exists(local_path))
+        self.assertFalse(os.path.exists(local_path + '.part'))
+        self.assertNotIn('package.tar.gz', self.manifest.local)
+
+    def test_offline_uses_local_manifest(self):
+        """offline, anything in the cache should be used, and anything else should fail rather than download"""
+        local_path = os.path.join(self.tmp.name, 'out', 'package.tar.gz')
+        fetch.fetch(self.url, local_path)
+        os.remove(self.source)
+
+        with mock.patch.object(fetch, '_offline', True):
+            again = os.path.join(self.tmp.name, 'out', 'again.tar.gz')
+            fetch.fetch(self.url, again)
+            self.assertEqual(self.contents, self._read(again))
+            with self.assertRaises(Exception):
+                fetch.fetch('file://' + self.source + '.missing', again)
+
+    def test_offline_package_not_in_cache(self):
+        """offline, a package that is only in the remote manifest should fail with a clear error"""
+        self.manifest.remote['package.tar.gz'] = self.digest
+        local_path = os.path.join(self.tmp.name, 'out', 'package.tar.gz')
+        with mock.patch.object(fetch, '_offline', True):
+            with self.assertRaisesRegex(Exception, 'not in the package cache and builder is offline'):
+                fetch.fetch(self.url, local_path)
+
+    def _make_tarball(self, files):
+        with tarfile.open(self.source, 'w:gz') as tar:
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.manifest.remote['package.tar.gz'] = fetch.hash_file(self.source)
+
+    def test_extracted_tree_is_shared(self):
+        """archives should be extracted once into a read-only tree, and linked or copied into each extract path"""
+        self._make_tarball({'jdk/bin/java': b'java', 'jdk/release': b'8'})
+        first = os.path.join(self.tmp.name, 'first')
+        fetch.fetch_and_extract(self.url, os.path.join(first, 'jdk.tar.gz'), first, cache=True)
+        self.assertTrue(os.path.islink(os.path.join(first, 'jdk')))
+        self.assertEqual(b'java', self._read(os.path.join(first, 'jdk', 'bin', 'java')))
+        tree = os.path.join(self.extract_cache_dir, self.manifest.remote['package.tar.gz'])
+        for path in (tree, os.path.join(tree, 'jdk', 'bin'), os.path.join(tree, 'jdk', 'bin', 'java')):
+            self.assertFalse(os.stat(path).st_mode & 0o222, path)
+
+        os.remove(self.source)
+        second = os.path.join(self.tmp.name, 'second')
+        with mock.patch.object(fetch, '_extract') as extract:
+            fetch.fetch_and_extract(self.url, os.path.join(second, 'jdk.tar.gz'), second, cache=True, link=False)
+        extract.assert_not_called()
+        # copies for containers are real, writable directories that don't share inodes with the tree
+        java = os.path.join(second, 'jdk', 'bin', 'java')
+        self.assertFalse(os.path.islink(os.path.join(second, 'jdk')))
+        self.assertFalse(os.path.samefile(os.path.join(first, 'jdk', 'bin', 'java'), java))
+        os.chmod(java, 0o755)
+        with open(java, 'ab') as f:
+            f.write(b' modified')
+        self.assertEqual(b'java', self._read(os.path.join(first, 'jdk', 'bin', 'java')))
+
+        # the tree counts towards the size of the cache
+        entry, = fetch.cache_entries()
+        self.assertEqual(len(b'java') + len(b'8'), entry.tree_size)
+
+        # a tree this process has symlinked into place is never evicted
+        self.assertEqual([], fetch.gc_cache(max_size=0))
+        self.assertTrue(os.path.isdir(tree))
+
+        # evicting the archive evicts its tree
+        fetch._trees_in_use.clear()
+        fetch.gc_cache(max_size=0)
+        self.assertEqual([], os.listdir(self.extract_cache_dir))
+
+    def test_extract_tar_streams(self):
+        """tarballs should be extracted in one pass, including read-only directories, via external tools if given"""
+        with tarfile.open(self.source, 'w:gz') as tar:
+            info = tarfile.TarInfo('pkg')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o555
+            tar.addfile(info)
+            info = tarfile.TarInfo('pkg/tool')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'tool'))
+        for decompressor in (None, [sys.executable, '-c',
+                                    'import gzip, shutil, sys; shutil.copyfileobj(gzip.open(sys.argv[1]), sys.stdout.buffer)',
+                                    self.source]):
+            dest = os.path.join(self.tmp.name, 'out-{}'.format(bool(decompressor)))
+            with mock.patch.object(fetch, '_external_decompressor', return_value=decompressor):
+                fetch._extract(self.source, dest)
+            self.assertEqual(b'tool', self._read(os.path.join(dest, 'pkg', 'tool')))
+            os.chmod(os.path.join(dest, 'pkg'), 0o755)
+
+    def test_extract_rejects_path_traversal(self):
+        """members outside of the extract path should be rejected, before anything is written there"""
+        self._make_tarball({'../escaped': b'evil'})
+        with self.assertRaises(Exception):
+            fetch._extract(self.source, os.path.join(self.tmp.name, 'out'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'escaped')))
+
+    def test_cache_gc_evicts_least_recently_used(self):
+        """the cache should stay under its size cap by evicting the least recently used packages"""
+        for i in range(3):
+            digest = sha256(bytes([i])).hexdigest()
+            path = os.path.join(self.cache_dir, digest)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (1000 + i, 1000 + i))
+        oldest, middle, newest = [entry.digest for entry in fetch.cache_entries()]
+        # a hit makes the oldest entry the most recently used
+        os.utime(os.path.join(self.cache_dir, oldest), (2000, 2000))
+
+        evicted = fetch.gc_cache(max_size=200)
+        self.assertEqual([middle], [entry.digest for entry in evicted])
+        self.assertEqual([newest, oldest], [entry.digest for entry in fetch.cache_entries()])
+
+        evicted = fetch.gc_cache(max_size=0, keep=oldest)
+        self.assertEqual([newest], [entry.digest for entry in evicted])
+        self.assertEqual([oldest], [entry.digest for entry in fetch.cache_entries()])
+
+    def test_mirror_packages(self):
+        """mirroring should download each url once, skip published packages and upload the manifest once"""
+        other = os.path.join(self.tmp.name, 'source', 'other.zip')
+        with open(other, 'wb') as f:
+            f.write(b'other')
+        self.manifest.remote['other.zip'] = sha256(b'other').hexdigest()
+
+        packages = [('A', self.url), ('A', self.url), ('B', self.url), ('C', 'file://' + other)]
+        with mock.patch.object(fetch, '_download', wraps=fetch._download) as download, \
+                mock.patch.object(fetch, 'run_commands') as run_commands, \
+                mock.patch.object(fetch, 'run_command') as run_command:
+            fetch.mirror_packages(packages)
+
+        self.assertEqual(2, download.call_count)
+        a_url = '{}/A/package.tar.gz'.format(fetch.PUBLISH_URL)
+        b_url = '{}/B/package.tar.gz'.format(fetch.PUBLISH_URL)
+        uploads, copies = [call.args[0] for call in run_commands.call_args_list]
+        self.assertEqual([a_url], [command[-1] for command in uploads])
+        self.assertEqual([['aws', 's3', 'cp', a_url, b_url]], copies)
+        self.assertEqual(self.digest, self.manifest.remote['package.tar.gz'])
+        run_command.assert_called_once()
+        self.assertEqual(fetch.PUBLISH_MANIFEST_URL, run_command.call_args.args[-1])
+
+        # nothing has changed, so nothing is published
+        with mock.patch.object(fetch, 'run_commands') as run_commands, \
+                mock.patch.object(fetch, 'run_command') as run_command:
+            fetch.mirror_packages(packages)
+        run_commands.assert_not_called()
+        run_command.assert_not_called()
+
+    def test_mirror_uploads_are_batched(self):
+        """no more than jobs uploads should run at once"""
+        packages = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.tmp.name, 'source', name + '.zip')
+            with open(path, 'wb') as f:
+                f.write(name.encode())
+            packages.append((name, 'file://' + path))
+
+        with mock.patch.object(fetch, 'run_commands') as run_commands, mock.patch.object(fetch, 'run_command'):
+            fetch.mirror_packages(packages, jobs=2)
+        self.assertEqual([2, 1], [len(call.args[0]) for call in run_commands.call_args_list])
+
+    def test_parse_size(self):
+        self.assertEqual(512, fetch.parse_size('512'))
+        self.assertEqual(5 * 1024 ** 3, fetch.parse_size('5G'))
+        self.assertEqual(10 * 1024 ** 2, fetch.parse_size('10mb'))
+        with self.assertRaises(ValueError):
+            fetch.parse_size('lots')
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.manifest_path = os.path.join(self.tmp.name, 'MANIFEST')
+        for patcher in (
+                mock.patch.object(fetch, 'MANIFEST_PATH', self.manifest_path),
+                mock.patch.object(fetch, 'MANIFEST_LOCK', os.path.join(self.tmp.name, 'manifest.lock')),
+                mock.patch.object(fetch, 'CACHE_DIR', os.path.join(self.tmp.name, 'pkg-cache')),
+                mock.patch.object(fetch.Manifest, '_fetch_remote', return_value={}),
+                mock.patch('atexit.register')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_writes_are_batched_and_merged(self):
+        """changes should only be written on flush, merged with other processes' changes"""
+        first = fetch.Manifest()
+        second = fetch.Manifest()
+        first.local['a.tar.gz'] = 'aaa'
+        first.local['b.tar.gz'] = 'bbb'
+        self.assertFalse(os.path.exists(self.manifest_path))
+
+        first.flush()
+        second.local['c.tar.gz'] = 'ccc'
+        second.flush()
+        del first.local['b.tar.gz']
+        first.flush()
+
+        expected = {'a.tar.gz': 'aaa', 'c.tar.gz': 'ccc'}
+        self.assertEqual(expected, fetch.Manifest._load_local())
+        self.assertEqual(expected, first.local)
+        self.assertEqual([], [name for name in os.listdir(self.tmp.name) if name.endswith('.tmp')])
+
+
+class TestRemoteManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_remote_manifest_is_cached(self):
+        """the remote manifest should be reused within its TTL, and then revalidated"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _ManifestHandler)
+        server.manifest = {'package.tar.gz': 'abc'}
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}/MANIFEST'.format(server.server_address[1])
+        with mock.patch.object(fetch, 'FETCH_MANIFEST_URL', url), \
+                mock.patch.object(fetch, 'REMOTE_MANIFEST_PATH', os.path.join(self.tmp.name, 'REMOTE_MANIFEST')):
+            self.assertEqual(server.manifest, fetch.Manifest._fetch_remote())
+            self.assertEqual(server.manifest, fetch.Manifest._fetch_remote())
+            self.assertEqual(1, len(server.requests))
+
+            with mock.patch.dict(os.environ, {'BUILDER_MANIFEST_TTL': '0'}):
+                self.assertEqual(server.manifest, fetch.Manifest._fetch_remote())
+            self.assertEqual(2, len(server.requests))
+            self.assertEqual(_ManifestHandler.etag, server.requests[1].get('If-None-Match'))
+
+            with mock.patch.object(fetch, '_offline', True), \
+                    mock.patch.dict(os.environ, {'BUILDER_MANIFEST_TTL': '0'}):
+                self.assertEqual(server.manifest, fetch.Manifest._fetch_remote())
+            self.assertEqual(2, len(server.requests))
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """ Serves server.contents, honoring Range requests, and failing ranges listed in server.failures """
+    protocol_version = 'HTTP/1.1'
+
+    def _headers(self, status, length):
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"contents"')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(self.server.contents))
+
+    def do_GET(self):
+        byte_range = self.headers.get('Range')
+        self.server.requests.append(byte_range)
+        if byte_range in self.server.failures:
+            self.server.failures[byte_range] -= 1
+            if self.server.failures[byte_range] == 0:
+                del self.server.failures[byte_range]
+            self.send_error(503)
+            return
+        start, end = [int(pos) for pos in byte_range[len('bytes='):].split('-')]
+        self._headers(206, end - start + 1)
+        self.wfile.write(self.server.contents[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRangedDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for patcher in (
+                mock.patch.object(fetch, 'RANGED_DOWNLOAD_MIN_SIZE', 1024),
+                mock.patch.object(fetch, 'RANGED_DOWNLOAD_CHUNK_SIZE', 1024),
+                mock.patch.object(fetch, 'CACHE_DIR', os.path.join(self.tmp.name, 'pkg-cache')),
+                mock.patch.object(fetch.time, 'sleep')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        self.server.contents = os.urandom(10 * 1024 + 100)
+        self.server.requests = []
+        self.server.failures = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/ndk.zip'.format(self.server.server_address[1])
+        self.local_path = os.path.join(self.tmp.name, 'deps', 'ndk.zip')
+        os.mkdir(os.path.dirname(self.local_path))
+
+    def _read(self):
+        with open(self.local_path, 'rb') as f:
+            return f.read()
+
+    def test_ranges_are_retried(self):
+        """each range should be fetched separately, and retried on its own if it fails"""
+        self.server.failures['bytes=2048-3071'] = 2
+        digest = fetch._download(self.url, self.local_path)
+        self.assertEqual(self.server.contents, self._read())
+        self.assertEqual(sha256(self.server.contents).hexdigest(), digest)
+        self.assertEqual(11 + 2, len(self.server.requests))
+        self.assertEqual(['ndk.zip'], os.listdir(os.path.dirname(self.local_path)))
+        self.assertEqual([], [name for name in os.listdir(os.path.dirname(fetch._partial_path(self.url)))
+                              if not name.endswith('.lock')])
+
+    def test_download_resumes(self):
+        """an interrupted download should resume, fetching only the ranges it is missing"""
+        self.server.failures['bytes=4096-5119'] = fetch.RANGED_DOWNLOAD_RETRIES + 1
+        with self.assertRaises(Exception):
+            fetch._download(self.url, self.local_path)
+        self.assertFalse(os.path.exists(self.local_path))
+        self.assertTrue(os.path.isfile(fetch._partial_path(self.url) + '.json'))
+
+        # the deps dir is cleaned between runs, the partial download is kept in the cache
+        shutil.rmtree(os.path.dirname(self.local_path))
+        os.mkdir(os.path.dirname(self.local_path))
+        self.server.requests = []
+        fetch._download(self.url, self.local_path)
+        self.assertEqual(self.server.contents, self._read())
+        self.assertEqual(['bytes=4096-5119'], self.server.requests)
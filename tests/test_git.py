@@ -0,0 +1,328 @@
+from collections import namedtuple
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import builder.core.api  # force API to load and expose the virtual module
+import builder.imports  # load up all known import classes
+from builder.actions import git, prefetch
+from builder.core.host import current_arch
+from builder.core.project import Import, Project
+from builder.core.spec import BuildSpec
+from builder.core.shell import Shell
+
+
+def _git(*args, cwd=None):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args], cwd=cwd, text=True).strip()
+
+
+class TestGitCache(unittest.TestCase):
+
+    def setUp(self):
+        Project._projects.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        # a bare repo standing in for a github remote
+        self.remote = os.path.join(self.tmp.name, 'remote', 'lib.git')
+        _git('init', '--bare', '--quiet', self.remote)
+        self.work = os.path.join(self.tmp.name, 'work')
+        _git('clone', '--quiet', self.remote, self.work)
+        self._commit('one')
+
+        cache_dir = os.path.join(self.tmp.name, 'git-cache')
+        patcher = mock.patch.object(git, 'GIT_CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.env = mock.Mock(name='MockEnv', shell=Shell())
+        self.env.args = namedtuple('Args', ['git_cache'])(True)
+
+    def _commit(self, name):
+        with open(os.path.join(self.work, name), 'w') as f:
+            f.write(name)
+        _git('add', name, cwd=self.work)
+        _git('commit', '--quiet', '-m', name, cwd=self.work)
+        _git('push', '--quiet', 'origin', 'HEAD', cwd=self.work)
+        return _git('rev-parse', 'HEAD', cwd=self.work)
+
+    def _clone(self, dest):
+        project = Project(name='lib', url='file://' + self.remote)
+        source = git.DownloadSource(project=project, branch='main', path=os.path.join(self.tmp.name, dest))
+        source.clone(self.env)
+        return source.path
+
+    def test_clone_references_cache(self):
+        """clones should borrow objects from the cache, and keep working without it"""
+        path = self._clone('deps')
+        self.assertTrue(os.path.isfile(os.path.join(path, 'one')))
+        self.assertTrue(os.listdir(git.GIT_CACHE_DIR))
+        self.assertFalse(os.path.exists(os.path.join(path, '.git', 'objects', 'info', 'alternates')))
+
+        # e.g. after the mirror has been pruned
+        Shell().rm(git.GIT_CACHE_DIR, quiet=True)
+        _git('fsck', cwd=path)
+
+    def test_submodules_use_cache(self):
+        """submodules should be cloned through the cache too"""
+        sub_remote = os.path.join(self.tmp.name, 'remote', 'sub.git')
+        _git('init', '--bare', '--quiet', sub_remote)
+        sub_work = os.path.join(self.tmp.name, 'sub-work')
+        _git('clone', '--quiet', sub_remote, sub_work)
+        with open(os.path.join(sub_work, 'sub'), 'w') as f:
+            f.write('sub')
+        _git('add', 'sub', cwd=sub_work)
+        _git('commit', '--quiet', '-m', 'sub', cwd=sub_work)
+        _git('push', '--quiet', 'origin', 'HEAD', cwd=sub_work)
+        _git('-c', 'protocol.file.allow=always', 'submodule', 'add', '--quiet', 'file://' + sub_remote, 'sub',
+             cwd=self.work)
+        _git('commit', '--quiet', '-m', 'add sub', cwd=self.work)
+        _git('push', '--quiet', 'origin', 'HEAD', cwd=self.work)
+
+        # git refuses file:// submodules by default
+        for var, value in (('GIT_CONFIG_COUNT', '1'), ('GIT_CONFIG_KEY_0', 'protocol.file.allow'),
+                           ('GIT_CONFIG_VALUE_0', 'always')):
+            self.env.shell.setenv(var, value, quiet=True)
+        path = self._clone('deps')
+        self.assertTrue(os.path.isfile(os.path.join(path, 'sub', 'sub')))
+        sub_cache = git._git_cache_path('file://' + sub_remote)
+        self.assertTrue(os.path.isdir(sub_cache))
+        self.assertEqual(_git('rev-parse', 'HEAD', cwd=sub_work), _git('rev-parse', 'HEAD', cwd=sub_cache))
+
+    def test_cache_is_incrementally_updated(self):
+        """the cache should pick up new commits from the remote on the next clone"""
+        self._clone('deps1')
+        head = self._commit('two')
+        path = self._clone('deps2')
+        self.assertEqual(head, _git('rev-parse', 'HEAD', cwd=path))
+        cache_path = git._git_cache_path('file://' + self.remote)
+        self.assertEqual(head, _git('rev-parse', 'HEAD', cwd=cache_path))
+
+    def test_cache_skips_pull_requests(self):
+        """the cache should hold the remote's branches and tags, but not its pull request refs"""
+        _git('push', '--quiet', 'origin', 'HEAD:refs/pull/1/head', cwd=self.work)
+        _git('tag', 'v1', cwd=self.work)
+        _git('push', '--quiet', 'origin', 'v1', cwd=self.work)
+        self._clone('deps1')
+
+        self._commit('two')
+        _git('tag', 'v2', cwd=self.work)
+        _git('push', '--quiet', 'origin', 'v2', 'HEAD:refs/pull/2/head', cwd=self.work)
+        self._clone('deps2')
+
+        cache_path = git._git_cache_path('file://' + self.remote)
+        refs = _git('for-each-ref', '--format=%(refname)', cwd=cache_path).split()
+        self.assertIn('refs/tags/v1', refs)
+        self.assertIn('refs/tags/v2', refs)
+        self.assertFalse([ref for ref in refs if ref.startswith('refs/pull/')], refs)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        Project._projects.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        # lib depends on sub, which is only discoverable once lib has been cloned
+        self.remotes = {}
+        for name, files in [('lib', {'builder.json': json.dumps({'name': 'lib', 'upstream': [{'name': 'sub'}],
+                                                                  'imports': ['pkg']})}),
+                            ('sub', {'sub.c': 'int sub;'})]:
+            remote = os.path.join(self.tmp.name, 'remote', name + '.git')
+            _git('init', '--bare', '--quiet', remote)
+            work = os.path.join(self.tmp.name, 'work', name)
+            _git('clone', '--quiet', remote, work)
+            for filename, contents in files.items():
+                with open(os.path.join(work, filename), 'w') as f:
+                    f.write(contents)
+            _git('add', '.', cwd=work)
+            _git('commit', '--quiet', '-m', name, cwd=work)
+            _git('push', '--quiet', 'origin', 'HEAD', cwd=work)
+            self.remotes[name] = 'file://' + remote
+
+        remotes = self.remotes
+        find_import_class = Project._find_import_class
+
+        class _RemoteProject(Project):
+            def __init__(self, **kwargs):
+                super().__init__(url=remotes[kwargs['name']], **kwargs)
+
+        class _PackageImport(Import):
+            def __init__(self, **kwargs):
+                super().__init__(name='pkg', config={}, **kwargs)
+
+            def resolved(self):
+                return True
+
+            def package_urls(self, spec=None):
+                return ['https://example.com/pkg-{}.tar.gz'.format(spec.target)]
+
+        # stands in for dockcross, the compiler of cross compiles
+        class _CrossImport(Import):
+            def __init__(self, **kwargs):
+                super().__init__(name='dockcross', config={}, compiler=True, **kwargs)
+
+            def resolved(self):
+                return True
+
+            def package_urls(self, spec=None):
+                return ['https://example.com/cross-{}.tar.gz'.format(spec.target)]
+
+        imports = {'pkg': _PackageImport, 'dockcross': _CrossImport}
+        for patcher in (
+                mock.patch.object(git, 'GIT_CACHE_DIR', os.path.join(self.tmp.name, 'git-cache')),
+                mock.patch.object(Project, '_find_project_class',
+                                  side_effect=lambda name: _RemoteProject if name in remotes else None),
+                mock.patch.object(Project, '_find_import_class',
+                                  side_effect=lambda name: imports.get(name) or find_import_class(name))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        root_dir = os.path.join(self.tmp.name, 'root')
+        os.mkdir(root_dir)
+        self.env = mock.Mock(name='MockEnv', shell=Shell(), branch='main')
+        self.env.spec = BuildSpec(target='linux')
+        self.env.project = Project(name='root', path=root_dir, upstream=[{'name': 'lib'}], imports=['pkg'])
+        self.env.args = namedtuple('Args', ['args', 'git_cache'])(
+            ['--prefetch-target', 'linux-' + current_arch(), '--prefetch-target', 'windows-x64'], False)
+
+    def test_prefetch_warms_caches(self):
+        """prefetch should fetch each package once per target, and every upstream repo into the git cache"""
+        with mock.patch.object(prefetch, 'fetch') as fetch, \
+                mock.patch.object(prefetch, 'get_manifest') as get_manifest:
+            prefetch.Prefetch().run(self.env)
+        get_manifest.assert_called_once_with()
+
+        # the cross compiler is only needed for windows
+        urls = sorted(call.args[0] for call in fetch.call_args_list)
+        self.assertEqual(['https://example.com/cross-windows.tar.gz', 'https://example.com/pkg-linux.tar.gz',
+                          'https://example.com/pkg-windows.tar.gz'], urls)
+        for name, url in self.remotes.items():
+            self.assertTrue(os.path.isdir(git._git_cache_path(url)), '{} was not cached'.format(name))
+        # the clones prefetch made are gone, so the build must not find them
+        for name in self.remotes:
+            project = Project._projects.get(name)
+            self.assertFalse(project and project.path, '{} is still cached'.format(name))
+
+
+class TestDownloadAll(unittest.TestCase):
+
+    def setUp(self):
+        Project._projects.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        # left and right both depend on shared, which is only discoverable once one of them has been cloned
+        self.remotes = {}
+        for name, upstream in [('left', ['shared']), ('right', ['shared']), ('shared', []), ('broken', [])]:
+            remote = os.path.join(self.tmp.name, 'remote', name + '.git')
+            _git('init', '--bare', '--quiet', remote)
+            work = os.path.join(self.tmp.name, 'work', name)
+            _git('clone', '--quiet', remote, work)
+            with open(os.path.join(work, 'builder.json'), 'w') as f:
+                json.dump({'name': name, 'upstream': [{'name': dep} for dep in upstream]}, f)
+            _git('add', '.', cwd=work)
+            _git('commit', '--quiet', '-m', name, cwd=work)
+            _git('push', '--quiet', 'origin', 'HEAD', cwd=work)
+            self.remotes[name] = 'file://' + remote
+
+        remotes = self.remotes
+
+        class _RemoteProject(Project):
+            def __init__(self, **kwargs):
+                super().__init__(url=remotes[kwargs['name']], **kwargs)
+
+        patcher = mock.patch.object(Project, '_find_project_class',
+                                    side_effect=lambda name: _RemoteProject if name in remotes else None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.deps_dir = os.path.join(self.tmp.name, 'deps')
+        os.mkdir(self.deps_dir)
+        # as Env does, so that clones are found once they land
+        patcher = mock.patch.object(Project, 'search_dirs', [self.deps_dir])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.env = mock.Mock(name='MockEnv', shell=Shell(), branch='main', deps_dir=self.deps_dir)
+        self.env.spec = BuildSpec(target='linux')
+        self.env.args = namedtuple('Args', ['git_cache'])(False)
+
+        # record when each clone starts and lands
+        self.events = []
+        clone = git.DownloadSource.clone
+
+        def _clone(source, env, prefix=None):
+            self.events.append(('start', source.project.name))
+            if source.project.name == 'broken':
+                raise Exception('clone of broken failed')
+            clone(source, env, prefix)
+            self.events.append(('end', source.project.name))
+
+        patcher = mock.patch.object(git.DownloadSource, 'clone', autospec=True, side_effect=_clone)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _download(self, names, jobs):
+        self.env.shell.pushd(self.deps_dir, quiet=True)
+        try:
+            git._download_all(self.env, [Project.find_project(name) for name in names], jobs)
+        finally:
+            self.env.shell.popd(quiet=True)
+
+    def test_transitive_dependencies_are_cloned_once(self):
+        """shared dependencies should be cloned once, after a project that needs them has landed"""
+        for jobs in (1, 4):
+            with self.subTest(jobs=jobs):
+                Project._projects.clear()
+                shutil.rmtree(self.deps_dir)
+                os.mkdir(self.deps_dir)
+                self.events.clear()
+
+                self._download(['left', 'right'], jobs)
+                self.assertEqual(['left', 'right', 'shared'], sorted(os.listdir(self.deps_dir)))
+                for name in ('left', 'right', 'shared'):
+                    self.assertTrue(os.path.isfile(os.path.join(self.deps_dir, name, 'builder.json')))
+                starts = [name for event, name in self.events if event == 'start']
+                self.assertEqual(['left', 'right', 'shared'], sorted(starts))
+                first_landed = min(self.events.index(('end', name)) for name in ('left', 'right'))
+                self.assertGreater(self.events.index(('start', 'shared')), first_landed)
+
+    def test_failed_clone_propagates(self):
+        """a clone that fails should fail the whole download"""
+        with self.assertRaisesRegex(Exception, 'clone of broken failed'):
+            self._download(['left', 'broken'], 4)
+
+    def test_kept_clones_are_updated(self):
+        """clones kept from a previous incremental build should be moved to the branch head or pinned revision"""
+        self._download(['shared'], 1)
+        path = os.path.join(self.deps_dir, 'shared')
+        first = _git('rev-parse', 'HEAD', cwd=path)
+
+        work = os.path.join(self.tmp.name, 'work', 'shared')
+        with open(os.path.join(work, 'new'), 'w') as f:
+            f.write('new')
+        _git('add', 'new', cwd=work)
+        _git('commit', '--quiet', '-m', 'new', cwd=work)
+        _git('push', '--quiet', 'origin', 'HEAD', cwd=work)
+        head = _git('rev-parse', 'HEAD', cwd=work)
+
+        Project._projects.clear()
+        self._download(['shared'], 1)
+        self.assertEqual(head, _git('rev-parse', 'HEAD', cwd=path))
+        self.assertEqual([('start', 'shared'), ('end', 'shared')], self.events,
+                         'kept clones should be updated, not cloned again')
+
+        Project._projects.clear()
+        pinned = namedtuple('Dependency', ['name', 'revision'])('shared', first)
+        self.env.shell.pushd(self.deps_dir, quiet=True)
+        try:
+            git._download_all(self.env, [pinned], 1)
+        finally:
+            self.env.shell.popd(quiet=True)
+        self.assertEqual(first, _git('rev-parse', 'HEAD', cwd=path))
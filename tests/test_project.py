@@ -2,6 +2,7 @@ import os
 import unittest
 import unittest.mock as mock
 
+from builder.core import project
 from builder.core.project import Project
 from builder.core.spec import BuildSpec
 from builder.actions.script import Script
@@ -216,3 +217,75 @@ class TestProject(unittest.TestCase):
         m_env = mock.Mock(name='MockEnv', config=config)
         steps = dependencies[0].post_build(m_env)
         self._assert_step_contains(steps, "{}/gradlew postBuildTask".format(os.path.join(test_data_dir, "lib-1")))
+
+    def test_config_is_memoized(self):
+        """configs should only be produced once per set of inputs, and each caller should get its own copy"""
+        config = _test_proj_config.copy()
+        config['cmake_args'] = ['-DFOO=ON']
+        spec = BuildSpec(target='linux')
+
+        with mock.patch('builder.core.project._produce_config', wraps=project._produce_config) as produce:
+            first = Project(**config).get_config(spec)
+            self.assertEqual(1, produce.call_count)
+            first['cmake_args'].append('-DMODIFIED=ON')
+            second = Project(**config).get_config(spec)
+            self.assertEqual(1, produce.call_count)
+            self.assertEqual(['-DFOO=ON'], second['cmake_args'])
+
+            # any change to the inputs produces a new config
+            Project(**config).get_config(BuildSpec(target='macos'))
+            self.assertEqual(2, produce.call_count)
+
+    def test_recompute_is_memoized(self):
+        """recomputing the config of a project (e.g. after use_variant) should be answered from the cache"""
+        config = _test_proj_config.copy()
+        config['name'] = 'test-recompute'
+        config['variants'] = {'bar': {'cmake_args': ['-DBAR=ON']}}
+        spec = BuildSpec(target='linux')
+        p = Project(**config)
+        p.get_config(spec)
+        self.assertIsNotNone(project._config_key(spec, p.config))
+
+        with mock.patch('builder.core.project._produce_config', wraps=project._produce_config) as produce:
+            # the first recompute is from the produced config, every one after that is from the same inputs
+            for _ in range(5):
+                p.use_variant(None)
+                p.get_config(spec)
+            self.assertEqual(1, produce.call_count)
+
+    def test_config_keys(self):
+        """only plain data should key the config cache, references by their contents"""
+        spec = BuildSpec(target='linux')
+        key = project._config_key(spec, {'upstream': [project.ProjectReference({'name': 'lib-1'})]})
+        self.assertEqual(key, project._config_key(BuildSpec(target='linux'),
+                                                  {'upstream': [project.ProjectReference({'name': 'lib-1'})]}))
+        self.assertNotEqual(key, project._config_key(spec, {'upstream': [project.ProjectReference(
+            {'name': 'lib-1', 'revision': 'v1'})]}))
+        self.assertNotEqual(project._config_key({'a': 1}), project._config_key({'a': True}))
+
+        # objects can't be told apart by their contents, so configs holding them aren't cached
+        self.assertIsNone(project._config_key(spec, {'build_steps': [lambda env: None]}))
+        self.assertIsNone(project._config_key(spec, {'upstream': [Project(**_test_proj_config)]}))
+
+    def test_variants_are_lazy(self):
+        """variants should only be produced when asked for, with any variables published before then"""
+        config = _test_proj_config.copy()
+        config['name'] = 'test-variants'
+        config['cmake_args'] = ['-DFOO=ON']
+        config['variants'] = {
+            'bar': {'cmake_args': ['-DBAR={bar}']},
+            'baz': {'cmake_args': ['-DBAZ=ON']},
+        }
+        spec = BuildSpec(target='linux')
+
+        p = Project._cache_project(Project(**config))
+        with mock.patch('builder.core.project._produce_config', wraps=project._produce_config) as produce:
+            variants = p.get_config(spec)['variants']
+            self.assertEqual(['bar', 'baz'], sorted(variants))
+            self.assertEqual(1, produce.call_count)
+
+            Project._publish_variable('bar', 'ON')
+            p.use_variant('bar')
+            self.assertEqual(['-DFOO=ON', '-DBAR=ON'], p.get_config(spec)['cmake_args'])
+            # baz was never asked for
+            self.assertEqual(3, produce.call_count)
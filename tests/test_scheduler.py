@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+
+from builder.core.scheduler import run_graph
+
+
+class TestScheduler(unittest.TestCase):
+
+    # c depends on a and b, d depends on c
+    graph = {
+        'a': [],
+        'b': [],
+        'c': ['a', 'b'],
+        'd': ['c'],
+    }
+
+    def _run(self, jobs):
+        finished = []
+        lock = threading.Lock()
+
+        def fn(node):
+            for dep in self.graph[node]:
+                self.assertIn(dep, finished)
+            time.sleep(0.01)
+            with lock:
+                finished.append(node)
+
+        run_graph(list(self.graph.keys()), lambda n: self.graph[n], fn, jobs)
+        return finished
+
+    def test_serial_order(self):
+        """serial runs should follow the order given, with dependencies first"""
+        self.assertEqual(['a', 'b', 'c', 'd'], self._run(1))
+
+    def test_parallel_respects_dependencies(self):
+        """parallel runs should only start a node once its dependencies have finished"""
+        finished = self._run(4)
+        self.assertEqual(['c', 'd'], finished[2:])
+        self.assertEqual({'a', 'b'}, set(finished[:2]))
+
+    def test_parallel_runs_concurrently(self):
+        """independent nodes should run at the same time"""
+        barrier = threading.Barrier(2, timeout=5)
+        run_graph(['a', 'b'], lambda n: [], lambda n: barrier.wait(), 2)
+
+    def test_failure_stops_scheduling(self):
+        """a failed node should raise, and nodes depending on it should not run"""
+        ran = []
+
+        def fn(node):
+            if node == 'a':
+                raise RuntimeError('a failed')
+            ran.append(node)
+
+        with self.assertRaises(RuntimeError):
+            run_graph(list(self.graph.keys()), lambda n: self.graph[n], fn, 2)
+        self.assertNotIn('c', ran)
+        self.assertNotIn('d', ran)
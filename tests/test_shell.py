@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+from builder.core.shell import Shell
+
+
+class TestShell(unittest.TestCase):
+
+    def test_env_overlays(self):
+        """pushenv/popenv should scope variables to commands without touching the process environment"""
+        sh = Shell()
+        sh.setenv('BUILDER_TEST_OUTER', 'outer', quiet=True)
+        sh.pushenv(quiet=True)
+        sh.setenv('BUILDER_TEST_INNER', 'inner', quiet=True)
+        sh.setenv('BUILDER_TEST_OUTER', 'shadowed', quiet=True)
+
+        self.assertNotIn('BUILDER_TEST_INNER', os.environ)
+        self.assertEqual('shadowed', sh.getenv('BUILDER_TEST_OUTER'))
+        result = sh.exec(sys.executable, '-c',
+                         'import os; print(os.environ["BUILDER_TEST_INNER"], os.environ["BUILDER_TEST_OUTER"])',
+                         quiet=True, capture='full')
+        self.assertEqual('inner shadowed\n', result.output)
+
+        sh.popenv(quiet=True)
+        self.assertIsNone(sh.getenv('BUILDER_TEST_INNER'))
+        self.assertEqual('outer', sh.getenv('BUILDER_TEST_OUTER'))
+        self.assertNotIn('BUILDER_TEST_INNER', sh.environ())
+        with self.assertRaises(IndexError):
+            sh.popenv(quiet=True)
+
+    def test_in_process_lookups(self):
+        """util.getenv/where/run_command should see the shell's environment, not just os.environ"""
+        from builder.core import util
+        sh = Shell()
+        sh.pushenv(quiet=True)
+        sh.setenv('BUILDER_TEST_LOOKUP', 'found', quiet=True)
+        sh.setenv('PATH', os.path.dirname(sys.executable), quiet=True)
+        try:
+            self.assertEqual('found', util.getenv('BUILDER_TEST_LOOKUP'))
+            self.assertEqual(os.path.realpath(sys.executable),
+                             os.path.realpath(util.where(os.path.basename(sys.executable))))
+            result = util.run_command(sys.executable, '-c',
+                                      'import os; print(os.environ["BUILDER_TEST_LOOKUP"])',
+                                      quiet=True, capture='full')
+            self.assertEqual('found\n', result.output)
+        finally:
+            sh.popenv(quiet=True)
+        self.assertIsNone(util.getenv('BUILDER_TEST_LOOKUP'))
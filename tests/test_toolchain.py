@@ -1,6 +1,9 @@
-
+import os
+import tempfile
 import unittest
+import unittest.mock as mock
 
+from builder.core import toolchain
 from builder.core.toolchain import Toolchain
 
 
@@ -16,3 +19,86 @@ class ToolchainTest(unittest.TestCase):
         all_compilers = toolchain.all_compilers()
         default_compiler = toolchain.default_compiler()
         self.assertIn(default_compiler, all_compilers)
+
+
+@unittest.skipIf(os.name == 'nt', 'compiler versions are not probed on windows')
+class ToolchainCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.bin_dir = os.path.join(self.tmp.name, 'bin')
+        os.mkdir(self.bin_dir)
+        self.gcc = self._write_compiler('gcc-99', '99.1.0')
+
+        for patcher in (
+                mock.patch.object(toolchain, 'TOOLCHAIN_CACHE_FILE', os.path.join(self.tmp.name, 'cache.json')),
+                mock.patch.object(toolchain, '_toolchain_cache', None),
+                mock.patch.object(toolchain, '_validated_path', None),
+                mock.patch.dict(os.environ, {'PATH': self.bin_dir}),
+                # look up tools in os.environ, rather than in the environment of a Shell made by another test
+                mock.patch.object(toolchain.util, '_environ_provider', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _write_compiler(self, name, version):
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as script:
+            script.write('#!/bin/sh\necho "gcc (GCC) {}"\n'.format(version))
+        os.chmod(path, 0o755)
+        return path
+
+    def _restart(self):
+        """ simulates a new builder run, which will read the cache back from disk """
+        toolchain._save_toolchain_cache()
+        toolchain._toolchain_cache = None
+        toolchain._validated_path = None
+
+    def test_discovery_is_cached(self):
+        """compilers found on PATH, and their versions, should be remembered between runs"""
+        self.assertEqual((self.gcc, '99'), Toolchain.find_gcc_tool('gcc', '99'))
+        self.assertEqual(('gcc', '99'), toolchain._compiler_version(self.gcc))
+        self._restart()
+        with mock.patch.object(toolchain.util, 'where') as where, \
+                mock.patch.object(toolchain.util, 'run_command') as run_command:
+            self.assertEqual((self.gcc, '99'), Toolchain.find_gcc_tool('gcc', '99'))
+            self.assertEqual(('gcc', '99'), toolchain._compiler_version(self.gcc))
+        where.assert_not_called()
+        run_command.assert_not_called()
+
+    def test_cache_is_invalidated(self):
+        """the cache should notice new executables on PATH, and changed compilers"""
+        self.assertEqual((None, None), Toolchain.find_gcc_tool('gcc', '98'))
+        self.assertEqual(('gcc', '99'), toolchain._compiler_version(self.gcc))
+        self._restart()
+
+        gcc98 = self._write_compiler('gcc-98', '98.1.0')
+        self._write_compiler('gcc-99', '99.20.0')
+        # directory mtimes are coarse, make sure the change is visible
+        mtime = os.stat(self.bin_dir).st_mtime + 10
+        os.utime(self.bin_dir, (mtime, mtime))
+        os.utime(self.gcc, (mtime, mtime))
+
+        self.assertEqual((gcc98, '98'), Toolchain.find_gcc_tool('gcc', '98'))
+        self.assertEqual(('gcc', '99'), toolchain._compiler_version(self.gcc))
+        with mock.patch.object(toolchain, '_probe_compiler_version', return_value=('gcc', '100')):
+            os.utime(self.gcc, (mtime + 10, mtime + 10))
+            self.assertEqual(('gcc', '100'), toolchain._compiler_version(self.gcc))
+
+    def test_path_is_validated_once(self):
+        """PATH should only be re-checked when it changes, or after tools are installed"""
+        with mock.patch.object(toolchain, '_path_fingerprint', wraps=toolchain._path_fingerprint) as fingerprint:
+            Toolchain.find_gcc_tool('gcc', '99')
+            Toolchain.find_gcc_tool('gcc', '98')
+            self.assertEqual(1, fingerprint.call_count)
+
+            gcc98 = self._write_compiler('gcc-98', '98.1.0')
+            mtime = os.stat(self.bin_dir).st_mtime + 10
+            os.utime(self.bin_dir, (mtime, mtime))
+            toolchain.invalidate_tool_cache()
+            self.assertEqual((gcc98, '98'), Toolchain.find_gcc_tool('gcc', '98'))
+            self.assertEqual(2, fingerprint.call_count)
+
+            with mock.patch.dict(os.environ, {'PATH': os.pathsep.join([self.tmp.name, self.bin_dir])}):
+                Toolchain.find_gcc_tool('gcc', '98')
+            self.assertEqual(3, fingerprint.call_count)
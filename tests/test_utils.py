@@ -1,4 +1,9 @@
+import asyncio
+import os
+import sys
+import tempfile
 import unittest
+import unittest.mock as mock
 import builder.core.util as utils
 
 
@@ -48,10 +53,172 @@ class TestUtils(unittest.TestCase):
         expected = {"f": "foo", "x": "qux", "b": "baz"}
         self.assertEqual(expected, utils.replace_variables(value, variables))
 
+    def test_compiled_templates(self):
+        """compiled templates should render exactly as the formatter does"""
+        variables = {'x': 'foo', 'n': 3, 'p': 1.5}
+        for value in ['', 'plain', '{x}', 'a{x}b{y}c', '{{x}}-{x}', '{n}/{p}', 'n={n:>4}', '<{x!r}>', 'a}}b']:
+            self.assertEqual(utils._formatter.format(value, **variables) if value != '{x}' else 'foo',
+                             utils.replace_variables(value, variables), value)
+
+        # each distinct string is only parsed once
+        utils._compile_template.cache_clear()
+        for _ in range(3):
+            utils.replace_variables('{x}-{n}', variables)
+        self.assertEqual(1, utils._compile_template.cache_info().misses)
+
+    def test_variable_index(self):
+        """publishing through the index should match replace_variables over the whole tree, touching only users"""
+        def tree():
+            return {
+                'a': '{x}/bin',
+                'b': ['{x}-{y}', 'plain', {'c': '{y}'}],
+                'd': '{z}',
+                'e': '{{x}}',
+            }
+
+        index_tree = tree()
+        index = utils.VariableIndex(index_tree)
+        expected = tree()
+        plain = index_tree['b']
+        for var, value in [('x', 'foo'), ('z', ['{y}', 'bar']), ('y', 'baz'), ('x', 'qux')]:
+            index.publish(var, value)
+            expected = utils.replace_variables(expected, {var: value})
+            self.assertEqual(expected, index_tree)
+
+        self.assertEqual({'a': 'foo/bin', 'b': ['foo-baz', 'plain', {'c': 'baz'}], 'd': ['baz', 'bar'], 'e': 'qux'},
+                         index_tree)
+        # lists are updated in place rather than rebuilt
+        self.assertIs(plain, index_tree['b'])
+
+    def test_run_command_capture(self):
+        """run_command should keep full, tail or no output as requested, and tee to a log"""
+        command = [sys.executable, '-c', 'for i in range(5): print(i)']
+        self.assertEqual('0\n1\n2\n3\n4\n', utils.run_command(command, quiet=True, capture='full').output)
+        self.assertEqual('', utils.run_command(command, quiet=True, capture='none').output)
+        with mock.patch.object(utils, 'OUTPUT_TAIL_LINES', 2):
+            self.assertEqual('3\n4\n', utils.run_command(command, quiet=True).output)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'build.log')
+            utils.run_command(command, capture='none', log_file=log_file)
+            with open(log_file) as log:
+                self.assertEqual('0\n1\n2\n3\n4\n', log.read())
+
+    def test_run_commands(self):
+        """run_commands should run commands concurrently, each in its own directory, keeping each return code"""
+        # each command waits for the other to start, so this would hang if they were run one at a time
+        script = '\n'.join([
+            'import os, sys, time',
+            'open(sys.argv[1], "w").close()',
+            'deadline = time.time() + 10',
+            'while not os.path.exists(sys.argv[2]) and time.time() < deadline: time.sleep(0.01)',
+            'if not os.path.exists(sys.argv[2]): sys.exit(2)',
+            'print(os.path.basename(os.getcwd()))',
+            'sys.exit(int(sys.argv[3]))',
+        ])
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ['a', 'b']:
+                os.mkdir(os.path.join(tmp, name))
+            a, b = os.path.join(tmp, 'a.started'), os.path.join(tmp, 'b.started')
+            with mock.patch('sys.stdout.write') as write:
+                results = utils.run_commands([
+                    {'command': [sys.executable, '-c', script, a, b, '0'],
+                     'working_dir': os.path.join(tmp, 'a'), 'prefix': 'first'},
+                    {'command': [sys.executable, '-c', script, b, a, '3'],
+                     'working_dir': os.path.join(tmp, 'b'), 'prefix': 'second'},
+                ], capture='full')
+            printed = [call.args[0] for call in write.call_args_list]
+
+        self.assertEqual(0, results[0].returncode)
+        self.assertEqual('a\n', results[0].output)
+        self.assertEqual(3, results[1].returncode)
+        self.assertEqual('b\n', results[1].output)
+        self.assertIsNone(results[0].error)
+        self.assertIsNotNone(results[1].error)
+        self.assertIn('[first] a\n', printed)
+        self.assertIn('[second] b\n', printed)
+
+    def test_run_command_in_event_loop(self):
+        """run_command should work when called from within a running event loop, and reuse each thread's loop"""
+        command = [sys.executable, '-c', 'print(6 * 7)']
+
+        async def main():
+            return utils.run_command(command, quiet=True, capture='full')
+
+        self.assertEqual('42\n', asyncio.run(main()).output)
+        utils.run_command(command, quiet=True)
+        loop = utils._thread_loops.current.loop
+        utils.run_command(command, quiet=True)
+        self.assertIs(loop, utils._thread_loops.current.loop)
+
+    @unittest.skipIf(sys.platform == 'win32', 'uses a shell script as the executable')
+    def test_where_index(self):
+        """where should answer from its index of PATH directories until PATH changes or the index is invalidated"""
+        def make_exe(directory, name):
+            path = os.path.join(directory, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(path, 0o755)
+            return path
+
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            path = os.pathsep.join([first, second])
+            tool = make_exe(second, 'builder-test-tool')
+            # age the directories, so that their listings are kept
+            for directory in (first, second):
+                os.utime(directory, ns=(0, 0))
+            self.assertEqual(os.path.realpath(tool), utils.where('builder-test-tool', path))
+            self.assertIsNone(utils.where('builder-test-other', path))
+
+            # once checked, listings are trusted without touching the filesystem
+            with mock.patch.object(utils.os, 'stat', wraps=os.stat) as stat, \
+                    mock.patch.object(utils.os, 'listdir', wraps=os.listdir) as listdir:
+                self.assertIsNone(utils.where('builder-test-other', path))
+            stat.assert_not_called()
+            listdir.assert_not_called()
+
+            # PATH order is respected, and new executables are seen once the index is invalidated
+            shadow = make_exe(first, 'builder-test-tool')
+            self.assertEqual(os.path.realpath(tool), utils.where('builder-test-tool', path))
+            utils.invalidate_where_cache()
+            with mock.patch.object(utils.os, 'listdir', wraps=os.listdir) as listdir:
+                self.assertEqual(os.path.realpath(shadow), utils.where('builder-test-tool', path))
+            # only the directory that changed is listed again
+            listdir.assert_called_once_with(first)
+
+            # or when PATH changes
+            os.remove(shadow)
+            os.utime(first, ns=(0, 0))
+            self.assertEqual(os.path.realpath(tool), utils.where('builder-test-tool', path + os.pathsep))
+
+            # paths to executables are not looked up in the index
+            self.assertEqual(os.path.realpath(tool), utils.where(tool, path))
+
+        # directories that have gone away are not remembered
+        utils.invalidate_where_cache()
+        self.assertIsNone(utils.where('builder-test-tool', path))
+        self.assertNotIn(first, utils._where_index)
+
     def test_list_unique(self):
         expected = [1, 2, 3]
         self.assertEqual(expected, utils.list_unique([1, 1, 2, 1, 3, 2, 1, 3]))
 
+    def test_unique_list(self):
+        """UniqueList should drop repeated objects and equal copies, with data tables hashed only once"""
+        import copy
+        from builder.core import data
+
+        linux = data.HOSTS['linux']
+        self.assertIs(linux, utils._content_hashes[id(linux)][0])
+
+        items = utils.UniqueList([linux, {'a': [1, 2]}])
+        items += [linux, copy.deepcopy(linux), {'a': [1, 2]}, {'a': [2, 1]}]
+        self.assertEqual([linux, {'a': [1, 2]}, {'a': [2, 1]}], list(items))
+
+        del items[0]
+        items.append(copy.deepcopy(linux))
+        self.assertEqual(3, len(items))
+
     def test_tree_transform(self):
         tree = {
             'foo': {